@@ -0,0 +1,89 @@
+"""
+Compares rendering one large template in a single process with serialization.dump_sharded.
+
+The template has a subnetwork and a firewall per region per env, like example_templates/networks.py
+driven from a big constants.ENV. Every sharded rendering is checked to be byte-identical to the
+single-process one.
+
+    $ python benchmarks/render_shards.py --sizes 1000,10000,50000 --processes 2,4,8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stratosphere import serialization  # noqa: E402
+from stratosphere.compute import Firewall, Network, Subnetwork  # noqa: E402
+from stratosphere.compute_properties import FirewallAllowedPorts  # noqa: E402
+from stratosphere.resources import Template  # noqa: E402
+
+
+class ShardedNetworks(Template):
+    TEMPLATE_TYPE = 'networks'
+
+    def __init__(self, project, env, size):
+        self.size = size
+        super(ShardedNetworks, self).__init__(project, env)
+
+    def configure(self):
+        network = Network(name='{}-network'.format(self.env), autoCreateSubnetworks=False)
+        self.add_resource(network)
+        for i in range(self.size // 2):
+            name = 'env{}-region{}'.format(i // 32, i % 32)
+            self.add_resource(Subnetwork(
+                name='{}-subnetwork'.format(name),
+                region='region{}'.format(i % 32),
+                description='{} - Subnetwork for {}'.format(self.env, name),
+                ipCidrRange='10.{}.{}.0/24'.format(i // 256 % 256, i % 256),
+                network=network.Ref))
+            self.add_resource(Firewall(
+                name='{}-internal-ssh'.format(name),
+                network=network.Ref,
+                allowed=[FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.TCP, ports=['22', '80', '443']),
+                         FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.ICMP)],
+                sourceRanges=['10.{}.0.0/16'.format(i // 256 % 256)]))
+
+
+def best_of(repeat, function):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000,50000', help='Comma separated resource counts')
+    parser.add_argument('--processes', default='2,4', help='Comma separated worker process counts')
+    parser.add_argument('--formats', default='yaml,json')
+    parser.add_argument('--yaml-backend', choices=sorted(serialization.YAML_BACKENDS), default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    serialization.set_backends(yaml_backend=args.yaml_backend)
+    print('cpus={} yaml backend={}'.format(os.cpu_count(), serialization.get_backends()['yaml']))
+    print('{:>8} {:>5} {:>10} {:>10} {:>8}'.format('size', 'fmt', 'processes', 'seconds', 'speedup'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        template = ShardedNetworks('project', 'bench', size)
+        template.ensure_configured()
+        resources = template.asObject()['resources']
+        for format in args.formats.split(','):
+            dump = serialization.dump_yaml if format == 'yaml' else serialization.dump_json
+            serial, expected = best_of(args.repeat, lambda: dump({'resources': resources}))
+            print('{:>8} {:>5} {:>10} {:>10.3f} {:>8}'.format(len(resources), format, 1, serial, '-'))
+            for processes in [int(p) for p in args.processes.split(',')]:
+                sharded, output = best_of(args.repeat, lambda: serialization.dump_sharded(
+                    resources, format, processes=processes))
+                if output != expected:
+                    raise AssertionError('Sharded {} output with {} processes differs'.format(format, processes))
+                print('{:>8} {:>5} {:>10} {:>10.3f} {:>7.2f}x'.format(len(resources), format, processes, sharded,
+                                                                     serial / sharded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+Offline benchmarks for building, validating, serializing and diffing resources.
+
+Synthetic templates mix Firewall, Instance, InstanceTemplate, BackendService and Cluster (with
+nested ClusterProperties) resources. Every phase is timed on its own, the best of --repeat runs
+is kept, and the results are written as JSON so runs can be compared over time:
+
+    $ python benchmarks/suite.py --sizes 100,1000,10000,100000 --output results.json
+    $ python benchmarks/suite.py --sizes 100,1000 --compare results.json
+
+Nothing here talks to GCP.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from stratosphere import serialization  # noqa: E402
+from stratosphere.compute import BackendService, Firewall, Instance, InstanceTemplate  # noqa: E402
+from stratosphere.compute_properties import (BackendServiceBackend, FirewallAllowedPorts,  # noqa: E402
+                                             InstanceTemplateDiskInitializeParamsProperty,
+                                             InstanceTemplateDisksProperty, InstanceTemplateMetadataProperty,
+                                             InstanceTemplateNetworkInterfaceProperty, InstanceTemplateProperty,
+                                             InstanceTemplateServiceAccountsProperty, InstanceTemplateTagsProperty,
+                                             MetadataProperty)
+from stratosphere.container_engine import Cluster  # noqa: E402
+from stratosphere.container_engine_properties import (ClusterProperties, NodeConfigProperty,  # noqa: E402
+                                                      NodePoolAutoScalingProperty, NodePoolProperty)
+from stratosphere.diff import diff_configs  # noqa: E402
+
+PHASES = ('construct', 'isValid', 'asObject', 'asObject_cached', 'hash', 'hash_cached', 'yaml', 'json', 'diff',
+          'diff_yaml')
+
+NETWORK = '$(ref.bench-network.selfLink)'
+SUBNETWORK = '$(ref.bench-subnetwork.selfLink)'
+
+
+def firewall(i, variant):
+    return Firewall(
+        name='bench-firewall-{}'.format(i),
+        description='rule {} v{}'.format(i, variant),
+        network=NETWORK,
+        allowed=[FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.TCP, ports=['22', str(1024 + i % 60000)]),
+                 FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.ICMP)],
+        sourceRanges=['10.{}.0.0/16'.format(i % 256)],
+        targetTags=['bench-{}'.format(i % 16)])
+
+
+def _instance_properties(i, variant):
+    return dict(
+        description='instance {} v{}'.format(i, variant),
+        machineType='n1-standard-1',
+        disks=[InstanceTemplateDisksProperty(
+            boot=True,
+            autoDelete=True,
+            type=InstanceTemplateDisksProperty.PERSISTENT,
+            initializeParams=InstanceTemplateDiskInitializeParamsProperty(
+                diskSizeGb=10 + i % 100,
+                diskType=InstanceTemplateDiskInitializeParamsProperty.SSD,
+                sourceImage='projects/debian-cloud/global/images/debian-9'))],
+        networkInterfaces=[InstanceTemplateNetworkInterfaceProperty(network=NETWORK, subnetwork=SUBNETWORK)],
+        metadata=InstanceTemplateMetadataProperty(items=[
+            MetadataProperty(key='startup-script', value='#!/bin/bash\necho {}\n'.format(i))]),
+        serviceAccounts=[InstanceTemplateServiceAccountsProperty(
+            email='default', scopes=['https://www.googleapis.com/auth/cloud-platform'])],
+        tags=InstanceTemplateTagsProperty(items=['bench-{}'.format(i % 16)]))
+
+
+def instance(i, variant):
+    properties = _instance_properties(i, variant)
+    properties['machineType'] = 'zones/us-central1-b/machineTypes/n1-standard-1'
+    return Instance(name='bench-instance-{}'.format(i), zone='us-central1-b', **properties)
+
+
+def instance_template(i, variant):
+    return InstanceTemplate(name='bench-instance-template-{}'.format(i),
+                            properties=InstanceTemplateProperty(**_instance_properties(i, variant)))
+
+
+def backend_service(i, variant):
+    return BackendService(
+        name='bench-backend-service-{}'.format(i),
+        description='backend {} v{}'.format(i, variant),
+        backends=[BackendServiceBackend(balancingMode=BackendServiceBackend.UTILIZATION, maxUtilization=0.8,
+                                        group='$(ref.bench-group-{}.instanceGroup)'.format(i))],
+        healthChecks=['$(ref.bench-health-check.selfLink)'],
+        port=80 + i % 1000,
+        portName='http',
+        protocol=BackendService.HTTP)
+
+
+def cluster(i, variant):
+    return Cluster(
+        name='bench-cluster-{}'.format(i),
+        zone='us-central1-b',
+        cluster=ClusterProperties(
+            description='cluster {} v{}'.format(i, variant),
+            network='bench-network',
+            subnetwork='bench-subnetwork',
+            locations=['us-central1-b', 'us-central1-c'],
+            nodePools=[NodePoolProperty(
+                name='pool-{}'.format(n),
+                initialNodeCount=1,
+                config=NodeConfigProperty(machineType='n1-standard-2', diskSizeGb=100,
+                                          oauthScopes=['https://www.googleapis.com/auth/compute']),
+                autoscaling=NodePoolAutoScalingProperty(enabled=True, minNodeCount=1, maxNodeCount=5))
+                for n in range(2)]))
+
+
+FACTORIES = (firewall, instance, instance_template, backend_service, cluster)
+
+
+def build(size, variant=0):
+    """size resources cycling through FACTORIES. variant changes the description of every 100th one."""
+    return [FACTORIES[i % len(FACTORIES)](i, variant if i % 100 == 0 else 0) for i in range(size)]
+
+
+def timed(function):
+    gc.collect()
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+def run_once(size):
+    timings = {}
+    timings['construct'], resources = timed(lambda: build(size))
+    timings['isValid'], _ = timed(lambda: [r.isValid() for r in resources])
+    timings['asObject'], objects = timed(lambda: [r.asObject() for r in resources])
+    timings['asObject_cached'], _ = timed(lambda: [r.asObject() for r in resources])
+    timings['hash'], _ = timed(lambda: [hash(r) for r in resources])
+    timings['hash_cached'], _ = timed(lambda: [hash(r) for r in resources])
+    document = {'resources': objects}
+    timings['yaml'], rendered = timed(lambda: serialization.dump_yaml(document))
+    timings['json'], _ = timed(lambda: serialization.dump_json(document))
+    proposed = {'resources': [r.asObject() for r in build(size, variant=1)]}
+    timings['diff'], diff = timed(lambda: diff_configs(document, proposed))
+    timings['diff_yaml'], _ = timed(lambda: diff_configs(rendered, proposed))
+    expected_changes = (size + 99) // 100
+    if len(diff.changed) != expected_changes:
+        raise AssertionError('Expected {} changed resources, got {}'.format(expected_changes, len(diff.changed)))
+    return timings
+
+
+def run(sizes, repeat):
+    results = []
+    for size in sizes:
+        best = {}
+        for _ in range(repeat):
+            for phase, seconds in run_once(size).items():
+                best[phase] = min(seconds, best.get(phase, seconds))
+        results.append({'size': size, 'seconds': best})
+        print_row(size, best)
+    return results
+
+
+def print_row(size, seconds, baseline=None):
+    cells = []
+    for phase in PHASES:
+        cell = '{:.4f}'.format(seconds[phase])
+        if baseline and baseline.get(phase):
+            cell += ' ({:+.0%})'.format(seconds[phase] / baseline[phase] - 1)
+        cells.append(cell)
+    print('{:>7} '.format(size) + ' '.join('{:>16}'.format(c) for c in cells))
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'backends': serialization.get_backends(),
+    }
+
+
+def compare(results, baseline_path, threshold):
+    """Prints the change against a previous run, returns the phases slower by more than threshold."""
+    with open(baseline_path) as f:
+        baseline = dict((r['size'], r['seconds']) for r in json.load(f)['results'])
+    regressions = []
+    print('\nCompared to {}:'.format(baseline_path))
+    for result in results:
+        previous = baseline.get(result['size'])
+        if previous is None:
+            continue
+        print_row(result['size'], result['seconds'], previous)
+        for phase in PHASES:
+            if previous.get(phase) and result['seconds'][phase] > previous[phase] * (1 + threshold):
+                regressions.append('{} at {} resources'.format(phase, result['size']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100,1000,10000,100000', help='Comma separated resource counts')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per size, the fastest is kept')
+    parser.add_argument('--yaml-backend', choices=sorted(serialization.YAML_BACKENDS), default=None)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='A previous --output file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='With --compare, exit with 1 if a phase got slower by more than this fraction')
+    args = parser.parse_args()
+
+    serialization.set_backends(yaml_backend=args.yaml_backend)
+    print('{:>7} '.format('size') + ' '.join('{:>16}'.format(p) for p in PHASES))
+    results = run([int(s) for s in args.sizes.split(',')], args.repeat)
+    report = {'environment': environment(), 'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print('Slower by more than {:.0%}: {}'.format(args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -36,6 +36,7 @@ class GKECluster(Template):
     https://cloud.google.com/container-engine/reference/rest/v1/projects.zones.clusters/create
     """
     TEMPLATE_TYPE = 'gke-cluster'
+    DEPENDS_ON = ('networks', )
 
     def configure(self):
         for cluster in constants.ENV[self.env]['gke_clusters']:
@@ -34,6 +34,7 @@ class NFSServer(Template):
     which in this case is 'nfs-server'.
     """
     TEMPLATE_TYPE = name
+    DEPENDS_ON = ('networks', )
 
     def configure(self):
         # Use ResourceNames to get names for networks and subnetworks to be consistent
@@ -0,0 +1,91 @@
+import logging
+import os
+import tempfile
+import time
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    # Python2
+    from urllib import quote
+
+try:
+    from stratosphere.serialization import dump_json, load_json
+except ImportError:
+    # Python2
+    from serialization import dump_json, load_json
+
+logger = logging.getLogger(__name__)
+
+
+def cache_root():
+    """
+    Base directory for stratosphere's on-disk caches: $STRATOSPHERE_CACHE_DIR if set,
+    otherwise $XDG_CACHE_HOME/stratosphere or ~/.cache/stratosphere.
+    """
+    root = os.environ.get('STRATOSPHERE_CACHE_DIR')
+    if root:
+        return os.path.abspath(os.path.expanduser(root))
+    xdg = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(xdg, 'stratosphere')
+
+
+class DiskCache(object):
+    """
+    A directory of JSON documents that expire after ttl seconds (None never expires).
+
+    Entries are keyed by a tuple of strings, e.g. ('compute', 'v1'), and stored in
+    <cache_root>/<namespace>/compute__v1.json. Age is taken from the file's mtime, so a
+    cache can be pre-seeded by copying files into place.
+    """
+    def __init__(self, namespace, ttl=None, root=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.directory = os.path.join(root or cache_root(), namespace)
+
+    def path(self, *key):
+        return os.path.join(self.directory, '__'.join(quote(str(k), safe='') for k in key) + '.json')
+
+    def age(self, *key):
+        """Seconds since the entry was written, or None if there is no entry."""
+        try:
+            return time.time() - os.path.getmtime(self.path(*key))
+        except OSError:
+            return None
+
+    def get(self, *key, **kwargs):
+        """
+        Returns the cached value for key, or None if it's missing, unreadable or expired.
+        Pass allow_stale=True to ignore the ttl, e.g. as a fallback when offline.
+        """
+        age = self.age(*key)
+        if age is None:
+            return None
+        if not kwargs.get('allow_stale') and self.ttl is not None and age > self.ttl:
+            logger.debug('%s cache entry %s expired (%ds old)', self.namespace, key, age)
+            return None
+        try:
+            with open(self.path(*key)) as f:
+                return load_json(f.read())
+        except (IOError, OSError, ValueError) as e:
+            logger.warning('Ignoring unreadable %s cache entry %s: %s', self.namespace, key, e)
+            return None
+
+    def set(self, value, *key):
+        """Stores value for key. Writes are atomic, so concurrent readers never see partial files."""
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                dump_json(value, f)
+            os.replace(tmp_path, self.path(*key))
+        except (IOError, OSError) as e:
+            # Caching is an optimization, never fail the actual work because of it
+            logger.warning('Unable to write %s cache entry %s: %s', self.namespace, key, e)
+
+    def delete(self, *key):
+        try:
+            os.remove(self.path(*key))
+        except OSError:
+            pass
@@ -8,25 +8,68 @@ except ImportError:
     from utils import get_google_auth
 
 
+# Registry of compiled validation regexes, keyed by pattern string. Every pattern is
+# compiled once per process, no matter how many values are validated against it.
+_compiled_patterns = {}
+
+
+def compiled_pattern(regex):
+    """
+    Returns the compiled form of regex, compiling and registering it on first use.
+    Already compiled patterns are returned as-is.
+    """
+    if not isinstance(regex, str):
+        return regex
+    try:
+        return _compiled_patterns[regex]
+    except KeyError:
+        return _compiled_patterns.setdefault(regex, re.compile(regex))
+
+
+NAME_PATTERN = compiled_pattern(r'^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$')
+BASE_INSTANCE_NAME_PATTERN = compiled_pattern(r'^[a-z][-a-z0-9]{0,57}$')
+SELF_LINK_REF_PATTERN = compiled_pattern(r'^\$\(ref\..*.selfLink\)$')
+HTTP_URL_PATTERN = compiled_pattern(r'^http.*$')
+
+
 class ResourceValidators(object):
     @classmethod
     def regex_match(cls, regex, string):
-        RE = re.compile(regex)
-        if RE.match(string):
+        if compiled_pattern(regex).match(string):
             return True
         return False
 
+    @classmethod
+    def validate_batch(cls, regex, values):
+        """
+        Checks every value against regex in one pass.
+
+        Returns a list of (index, value) tuples for each value that doesn't match, which is
+        empty if all of them are valid. Non-string values are reported as failures.
+        """
+        match = compiled_pattern(regex).match
+        return [(i, value) for i, value in enumerate(values)
+                if not (isinstance(value, str) and match(value))]
+
+    @classmethod
+    def validate_names(cls, names):
+        """
+        Validates a whole list of resource names, e.g. every firewall or subnetwork name of
+        an environment, and reports all failing indexes at once. See validate_batch.
+        """
+        return cls.validate_batch(NAME_PATTERN, names)
+
     @staticmethod
     def name(name):
-        return ResourceValidators.regex_match('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', name)
+        return ResourceValidators.regex_match(NAME_PATTERN, name)
 
     @staticmethod
     def zone(zone):
-        return ResourceValidators.regex_match('^(?:[a-z](?:[-a-z0-9]{0,61}[a-z0-9])?)$', zone)
+        return ResourceValidators.regex_match(NAME_PATTERN, zone)
 
     @staticmethod
     def base_instance_name(name):
-        return ResourceValidators.regex_match('^[a-z][-a-z0-9]{0,57}$', name)
+        return ResourceValidators.regex_match(BASE_INSTANCE_NAME_PATTERN, name)
 
     @staticmethod
     def ipAddress(network):
@@ -61,9 +104,9 @@ class ResourceValidators(object):
 
     @staticmethod
     def is_url(value):
-        if ResourceValidators.regex_match('^\$\(ref\..*.selfLink\)$', value):
+        if ResourceValidators.regex_match(SELF_LINK_REF_PATTERN, value):
             return True
-        if ResourceValidators.regex_match('^http.*$', value):
+        if ResourceValidators.regex_match(HTTP_URL_PATTERN, value):
             return True
         return False
 
@@ -0,0 +1,195 @@
+import difflib
+import json
+from collections import namedtuple
+
+try:
+    from stratosphere.serialization import load_yaml
+except ImportError:
+    # Python2
+    from serialization import load_yaml
+
+
+class _Missing(object):
+    def __repr__(self):
+        return '<missing>'
+
+
+# Marks the absent side of an added or removed property
+MISSING = _Missing()
+
+# Longest rendered value shown in a property change line
+MAX_VALUE_LENGTH = 200
+
+
+class PropertyChange(namedtuple('PropertyChange', ['path', 'old', 'new'])):
+    """A single changed value, path is like properties.allowed[0].ports"""
+    @property
+    def kind(self):
+        if self.old is MISSING:
+            return 'added'
+        if self.new is MISSING:
+            return 'removed'
+        return 'changed'
+
+    def asObject(self):
+        _object = {'path': self.path, 'kind': self.kind}
+        if self.old is not MISSING:
+            _object['old'] = self.old
+        if self.new is not MISSING:
+            _object['new'] = self.new
+        return _object
+
+
+class ResourceDiff(namedtuple('ResourceDiff', ['name', 'type', 'status', 'changes'])):
+    """status is added, removed or changed. changes are only listed for changed resources."""
+    def asObject(self):
+        return {
+            'name': self.name,
+            'type': self.type,
+            'status': self.status,
+            'changes': [c.asObject() for c in self.changes],
+        }
+
+
+class ConfigDiff(object):
+    """
+    The resource and property level differences between two Deployment Manager configs.
+    It's falsy if there are none.
+    """
+    def __init__(self, resources):
+        self.resources = resources
+
+    def _with_status(self, status):
+        return [r for r in self.resources if r.status == status]
+
+    @property
+    def added(self):
+        return self._with_status('added')
+
+    @property
+    def removed(self):
+        return self._with_status('removed')
+
+    @property
+    def changed(self):
+        return self._with_status('changed')
+
+    def __bool__(self):
+        return bool(self.resources)
+    __nonzero__ = __bool__
+
+    def summary(self):
+        return '{} to add, {} to change, {} to remove'.format(len(self.added), len(self.changed), len(self.removed))
+
+    def lines(self):
+        """
+        Yields a human readable rendering of the diff, each line starting with + (added),
+        - (removed) or ~ (changed) after its indentation.
+        """
+        for _, line in self.entries():
+            yield line
+
+    def entries(self):
+        """
+        Yields (kind, line) for every line of lines(). kind is added, removed or changed, for
+        the line diffs of multi-line values also context or hunk (an @@ header), so lines can
+        be told apart without parsing them again.
+        """
+        markers = {'added': '+', 'removed': '-', 'changed': '~'}
+        line_kinds = {'+': 'added', '-': 'removed', ' ': 'context', '@': 'hunk'}
+        for resource in self.resources:
+            yield resource.status, '{} {} ({})'.format(markers[resource.status], resource.name, resource.type)
+            for change in resource.changes:
+                if change.kind == 'changed' and _is_text(change.old) and _is_text(change.new):
+                    yield 'changed', '    ~ {}:'.format(change.path)
+                    diff = difflib.unified_diff(change.old.splitlines(), change.new.splitlines(), lineterm='', n=1)
+                    for line in diff:
+                        if not line.startswith(('---', '+++')):
+                            yield line_kinds.get(line[:1], 'context'), '        ' + line
+                elif change.kind == 'changed':
+                    yield 'changed', '    ~ {}: {} -> {}'.format(change.path, _format(change.old), _format(change.new))
+                else:
+                    value = change.new if change.kind == 'added' else change.old
+                    yield change.kind, '    {} {}: {}'.format(markers[change.kind], change.path, _format(value))
+
+    def asObject(self):
+        return {
+            'summary': self.summary(),
+            'resources': [r.asObject() for r in self.resources],
+        }
+
+
+def _is_text(value):
+    # Multi-line strings, e.g. startup scripts, get a line diff of their own
+    return isinstance(value, str) and '\n' in value
+
+
+def _format(value):
+    text = json.dumps(value, sort_keys=True, default=str)
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH] + '...'
+    return text
+
+
+def diff_values(old, new, path=''):
+    """Returns the PropertyChanges between two serialized values, recursing into dicts and lists."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes = []
+        for key in sorted(set(old) | set(new), key=str):
+            key_path = '{}.{}'.format(path, key) if path else str(key)
+            if key not in old:
+                changes.append(PropertyChange(key_path, MISSING, new[key]))
+            elif key not in new:
+                changes.append(PropertyChange(key_path, old[key], MISSING))
+            else:
+                changes.extend(diff_values(old[key], new[key], key_path))
+        return changes
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for i in range(max(len(old), len(new))):
+            item_path = '{}[{}]'.format(path, i)
+            if i >= len(old):
+                changes.append(PropertyChange(item_path, MISSING, new[i]))
+            elif i >= len(new):
+                changes.append(PropertyChange(item_path, old[i], MISSING))
+            else:
+                changes.extend(diff_values(old[i], new[i], item_path))
+        return changes
+    if old != new or type(old) is not type(new):
+        return [PropertyChange(path, old, new)]
+    return []
+
+
+def _resources(config):
+    if config is None:
+        return []
+    if not isinstance(config, dict):
+        config = load_yaml(config) or {}
+    return config.get('resources') or []
+
+
+def diff_configs(existing, proposed):
+    """
+    Compares two configs, each either YAML/JSON text or a parsed {'resources': [...]} dict.
+
+    Resources are matched by name through a dict, so the cost is linear in the number of
+    resources, and key order or resource order changes don't show up as differences.
+    """
+    existing_resources = _resources(existing)
+    existing_by_name = dict((r.get('name'), r) for r in existing_resources)
+    proposed_names = set()
+    resources = []
+    for resource in _resources(proposed):
+        name = resource.get('name')
+        proposed_names.add(name)
+        old = existing_by_name.get(name)
+        if old is None:
+            resources.append(ResourceDiff(name, resource.get('type'), 'added', []))
+            continue
+        changes = diff_values(old, resource)
+        if changes:
+            resources.append(ResourceDiff(name, resource.get('type'), 'changed', changes))
+    for resource in existing_resources:
+        if resource.get('name') not in proposed_names:
+            resources.append(ResourceDiff(resource.get('name'), resource.get('type'), 'removed', []))
+    return ConfigDiff(resources)
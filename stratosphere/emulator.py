@@ -0,0 +1,358 @@
+"""
+An in-process stand-in for the Deployment Manager v2 API, for trying out and load testing the
+apply pipeline (planning, polling, concurrency) without GCP access.
+
+The emulator speaks HTTP at the httplib2 level: the regular googleapiclient client is built
+with the emulator as its connection, so request building, responses and HttpErrors are all
+real. It implements deployments get/list/insert/update/patch/delete, manifests get, resources
+list and operations get. Operations take operation_seconds to finish, working through the
+deployment's resources one after the other.
+
+With the CLI, pass --dm-emulator STATE_FILE (or set STRATOSPHERE_DM_EMULATOR). The state file
+keeps deployments and manifests between runs, use '-' to keep them in memory only. Behaviour is
+tuned with these environment variables:
+
+    STRATOSPHERE_DM_EMULATOR_LATENCY            seconds added to every request (default 0)
+    STRATOSPHERE_DM_EMULATOR_FAILURE_RATE       fraction of requests failing with a 503 (default 0)
+    STRATOSPHERE_DM_EMULATOR_OPERATION_SECONDS  time for an operation to finish (default 1)
+    STRATOSPHERE_DM_EMULATOR_FAIL_DEPLOYMENTS   comma separated deployments whose operations fail
+"""
+import base64
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    # Python2
+    from urlparse import urlparse
+
+try:
+    from stratosphere.serialization import load_yaml
+    from stratosphere.utils import get_discovery_document, register_client
+except ImportError:
+    # Python2
+    from serialization import load_yaml
+    from utils import get_discovery_document, register_client
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = '/deploymentmanager/v2/projects/'
+SELF_LINK = 'https://www.googleapis.com/deploymentmanager/v2/projects/{}/global/{}'
+
+
+class EmulatorError(Exception):
+    def __init__(self, status, reason, message):
+        super(EmulatorError, self).__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+
+class DeploymentManagerEmulator(object):
+    """
+    latency (float): Seconds every request takes
+    failure_rate (float): Fraction of requests that fail with 503 backendError
+    operation_seconds (float): Time from an insert/update/delete until its operation is DONE
+    fail_deployments (iterable): Deployment names whose operations finish with an error
+    state_path (str): JSON file the deployments, manifests and operations are kept in
+    rand, sleep, clock: Injectable for tests
+    """
+    def __init__(self, latency=0.0, failure_rate=0.0, operation_seconds=1.0, fail_deployments=(), state_path=None,
+                 rand=random.random, sleep=time.sleep, clock=time.time):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.operation_seconds = operation_seconds
+        self.fail_deployments = set(fail_deployments)
+        self.state_path = state_path
+        self.rand = rand
+        self.sleep = sleep
+        self.clock = clock
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.state = {'deployments': {}, 'manifests': {}, 'operations': {}, 'counter': 0}
+        if state_path and os.path.isfile(state_path):
+            with open(state_path) as f:
+                self.state.update(json.load(f))
+
+    @classmethod
+    def from_environment(cls, state_path=None):
+        environ = os.environ
+        fail = environ.get('STRATOSPHERE_DM_EMULATOR_FAIL_DEPLOYMENTS', '')
+        return cls(latency=float(environ.get('STRATOSPHERE_DM_EMULATOR_LATENCY', 0)),
+                   failure_rate=float(environ.get('STRATOSPHERE_DM_EMULATOR_FAILURE_RATE', 0)),
+                   operation_seconds=float(environ.get('STRATOSPHERE_DM_EMULATOR_OPERATION_SECONDS', 1)),
+                   fail_deployments=[d for d in fail.split(',') if d],
+                   state_path=state_path)
+
+    # httplib2.Http interface, as used by googleapiclient
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        import httplib2
+        if self.latency:
+            self.sleep(self.latency)
+        try:
+            with self._lock:
+                self.requests += 1
+                if self.failure_rate and self.rand() < self.failure_rate:
+                    raise EmulatorError(503, 'backendError', 'Injected failure')
+                status, result = 200, self._handle(method, uri, json.loads(body) if body else None)
+                if self._dirty:
+                    self._save()
+        except EmulatorError as e:
+            status, result = e.status, {'error': {'code': e.status, 'message': e.message,
+                                                  'errors': [{'reason': e.reason, 'message': e.message}]}}
+        logger.debug('%s %s -> %s', method, uri, status)
+        response = httplib2.Response({'status': str(status), 'content-type': 'application/json; charset=UTF-8'})
+        return response, json.dumps(result).encode('utf-8')
+
+    def close(self):
+        pass
+
+    # Routing
+
+    def _handle(self, method, uri, body):
+        url = urlparse(uri)
+        if not url.path.startswith(API_PREFIX):
+            raise EmulatorError(404, 'notFound', 'Unknown URL {}'.format(uri))
+        parts = url.path[len(API_PREFIX):].strip('/').split('/')
+        project, parts = parts[0], parts[2:]  # skip 'global'
+        self._dirty = self._advance(project) or method != 'GET'
+        if parts[:1] == ['operations'] and len(parts) == 2 and method == 'GET':
+            return self._operation(project, parts[1])
+        if parts[:1] != ['deployments']:
+            raise EmulatorError(404, 'notFound', 'Unknown URL {}'.format(uri))
+        if len(parts) == 1:
+            if method == 'GET':
+                return {'deployments': list(self._deployments(project).values())}
+            if method == 'POST':
+                return self._insert(project, body)
+        elif len(parts) == 2:
+            if method == 'GET':
+                return self._deployment(project, parts[1])
+            if method in ('PUT', 'PATCH'):
+                return self._update(project, parts[1], body, patch=method == 'PATCH')
+            if method == 'DELETE':
+                return self._delete(project, parts[1])
+        elif len(parts) == 3 and parts[2] == 'resources' and method == 'GET':
+            return {'resources': self._resources(project, parts[1])}
+        elif len(parts) == 4 and parts[2] == 'manifests' and method == 'GET':
+            return self._manifest(project, parts[1], parts[3])
+        raise EmulatorError(400, 'badRequest', 'Unsupported request {} {}'.format(method, uri))
+
+    # Deployments
+
+    def _deployments(self, project):
+        return self.state['deployments'].setdefault(project, OrderedDict())
+
+    def _deployment(self, project, name):
+        deployment = self._deployments(project).get(name)
+        if deployment is None:
+            raise EmulatorError(404, 'notFound', "The object 'projects/{}/global/deployments/{}' is not found."
+                                .format(project, name))
+        return deployment
+
+    def _next_id(self):
+        self.state['counter'] += 1
+        return self.state['counter']
+
+    def _fingerprint(self):
+        return base64.b64encode(os.urandom(8)).decode('ascii')
+
+    def _check_ready(self, deployment):
+        if deployment['operation']['status'] != 'DONE':
+            raise EmulatorError(409, 'conflict', "Resource '{}' has an operation in progress: {}".format(
+                deployment['name'], deployment['operation']['name']))
+
+    def _insert(self, project, body):
+        name = body.get('name')
+        if name in self._deployments(project):
+            raise EmulatorError(409, 'alreadyExists', "The resource 'projects/{}/global/deployments/{}' already "
+                                                      "exists".format(project, name))
+        deployment = {
+            'id': str(self._next_id()),
+            'name': name,
+            'description': body.get('description'),
+            'labels': body.get('labels', []),
+            'insertTime': self._timestamp(),
+            'fingerprint': self._fingerprint(),
+            'selfLink': SELF_LINK.format(project, 'deployments/' + name),
+        }
+        self._deployments(project)[name] = deployment
+        return self._start(project, deployment, 'insert', body)
+
+    def _update(self, project, name, body, patch=False):
+        deployment = self._deployment(project, name)
+        self._check_ready(deployment)
+        if body.get('fingerprint') != deployment['fingerprint']:
+            raise EmulatorError(412, 'conditionNotMet', 'Fingerprint {} does not match {} of deployment {}'.format(
+                body.get('fingerprint'), deployment['fingerprint'], name))
+        if 'target' not in body and patch:
+            body = dict(body, target={'config': {'content': self._current_config(project, deployment)}})
+        for key in ('description', 'labels'):
+            if key in body or not patch:
+                deployment[key] = body.get(key)
+        deployment['fingerprint'] = self._fingerprint()
+        return self._start(project, deployment, 'update', body)
+
+    def _delete(self, project, name):
+        deployment = self._deployment(project, name)
+        self._check_ready(deployment)
+        deployment['fingerprint'] = self._fingerprint()
+        return self._start(project, deployment, 'delete', None)
+
+    def _current_config(self, project, deployment):
+        manifest = self.state['manifests'].get(project, {}).get(deployment.get('manifest', '').split('/')[-1])
+        return manifest['config']['content'] if manifest else ''
+
+    def _manifest(self, project, deployment, name):
+        manifest = self.state['manifests'].get(project, {}).get(name)
+        if manifest is None or manifest['deployment'] != deployment:
+            raise EmulatorError(404, 'notFound', "The object 'projects/{}/global/deployments/{}/manifests/{}' is "
+                                                 "not found.".format(project, deployment, name))
+        return dict((k, v) for k, v in manifest.items() if k != 'deployment')
+
+    def _resources(self, project, name):
+        """
+        The resources of the deployment's pending (or else current) manifest. While an operation
+        runs they finish in order, so its progress decides how many are COMPLETED. When it
+        failed, the resource it was working on when half done is FAILED.
+        """
+        deployment = self._deployment(project, name)
+        manifest_link = (deployment.get('update') or deployment).get('manifest', '')
+        manifest = self.state['manifests'].get(project, {}).get(manifest_link.split('/')[-1])
+        config = load_yaml(manifest['config']['content']) if manifest else None
+        entries = (config or {}).get('resources') or []
+        # deployment['operation'] is only a snapshot taken when the operation started or finished
+        operation = self.state['operations'][project][deployment['operation']['name']]
+        if operation['status'] != 'DONE':
+            done, current = len(entries) * operation.get('progress', 0) // 100, 'IN_PROGRESS'
+        elif operation.get('error'):
+            done, current = len(entries) // 2, 'FAILED'
+        else:
+            done, current = len(entries), None
+        resources = []
+        for i, entry in enumerate(entries):
+            resource = {'id': '{}-{}'.format(deployment['id'], i), 'name': entry.get('name'), 'type': entry.get('type'),
+                        'manifest': manifest_link}
+            if i >= done:
+                resource['update'] = {'manifest': manifest_link, 'state': current if i == done else 'PENDING'}
+                if current == 'FAILED' and i == done:
+                    resource['update']['error'] = {'errors': operation['error']['errors']}
+            resources.append(resource)
+        return resources
+
+    # Operations
+
+    def _start(self, project, deployment, kind, body):
+        operation_id = self._next_id()
+        operation = {
+            'kind': 'deploymentmanager#operation',
+            'id': str(operation_id),
+            'name': 'operation-{}-{}'.format(int(self.clock() * 1000), operation_id),
+            'operationType': kind,
+            'targetLink': SELF_LINK.format(project, 'deployments/' + deployment['name']),
+            'targetId': deployment['id'],
+            'status': 'PENDING',
+            'progress': 0,
+            'insertTime': self._timestamp(),
+            'startTime': self.clock(),
+        }
+        operation['selfLink'] = SELF_LINK.format(project, 'operations/' + operation['name'])
+        if body is not None:
+            manifest = 'manifest-{}'.format(self._next_id())
+            self.state['manifests'].setdefault(project, {})[manifest] = {
+                'name': manifest,
+                'id': manifest.split('-')[-1],
+                'deployment': deployment['name'],
+                'config': {'content': body.get('target', {}).get('config', {}).get('content', '')},
+                'insertTime': self._timestamp(),
+                'selfLink': SELF_LINK.format(project, 'deployments/{}/manifests/{}'.format(deployment['name'],
+                                                                                           manifest)),
+            }
+            deployment['update'] = {'manifest': self.state['manifests'][project][manifest]['selfLink']}
+        self.state['operations'].setdefault(project, {})[operation['name']] = operation
+        deployment['operation'] = self._public(operation)
+        return deployment['operation']
+
+    def _operation(self, project, name):
+        operation = self.state['operations'].get(project, {}).get(name)
+        if operation is None:
+            raise EmulatorError(404, 'notFound', "The object 'projects/{}/global/operations/{}' is not found."
+                                .format(project, name))
+        return self._public(operation)
+
+    def _public(self, operation):
+        return dict((k, v) for k, v in operation.items() if k != 'startTime')
+
+    def _advance(self, project):
+        """
+        Moves every operation of project along according to the time since it started. Returns
+        True if one of them finished.
+        """
+        finished = False
+        for operation in self.state['operations'].get(project, {}).values():
+            if operation['status'] == 'DONE':
+                continue
+            elapsed = self.clock() - operation['startTime']
+            if elapsed < self.operation_seconds:
+                operation['status'] = 'RUNNING' if elapsed > 0 else 'PENDING'
+                operation['progress'] = int(100 * elapsed / self.operation_seconds) if self.operation_seconds else 0
+                continue
+            finished = True
+            operation['status'] = 'DONE'
+            operation['progress'] = 100
+            operation['endTime'] = self._timestamp()
+            name = operation['targetLink'].split('/')[-1]
+            deployment = self._deployments(project).get(name)
+            if name in self.fail_deployments:
+                operation['error'] = {'errors': [{'code': 'RESOURCE_ERROR', 'location': name,
+                                                  'message': 'Injected failure of deployment {}'.format(name)}]}
+                operation['httpErrorStatusCode'] = 400
+            if deployment is None:
+                continue
+            if not operation.get('error'):
+                if operation['operationType'] == 'delete':
+                    del self._deployments(project)[name]
+                    continue
+                # A failed insert/update leaves the new manifest pending in deployment['update']
+                if 'update' in deployment:
+                    deployment['manifest'] = deployment.pop('update')['manifest']
+            deployment['fingerprint'] = self._fingerprint()
+            deployment['operation'] = self._public(operation)
+        return finished
+
+    # Persistence
+
+    def _timestamp(self):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.clock())) + '.000-00:00'
+
+    def _save(self):
+        if not self.state_path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_path, self.state_path)
+
+
+def install(emulator=None):
+    """
+    Makes get_client('deploymentmanager', 'v2') return a client backed by emulator (by default
+    one configured from the environment). No credentials are needed for it. Returns the emulator.
+    """
+    from googleapiclient import discovery
+    emulator = emulator or DeploymentManagerEmulator.from_environment()
+    client = discovery.build_from_document(get_discovery_document('deploymentmanager', 'v2'), http=emulator)
+    register_client('deploymentmanager', 'v2', client, shared_http=emulator)
+    logger.info('Using the Deployment Manager emulator%s',
+                ' with state in {}'.format(emulator.state_path) if emulator.state_path else '')
+    return emulator
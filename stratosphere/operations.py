@@ -0,0 +1,167 @@
+import logging
+import random
+import time
+from collections import Counter, namedtuple
+
+logger = logging.getLogger(__name__)
+
+# One observed state of an operation, as yielded by OperationPoller.poll(). resources is a tuple
+# of (resource name, state) of the deployment the operation works on, empty if not tracked.
+OperationProgress = namedtuple('OperationProgress', ['name', 'target', 'status', 'progress', 'elapsed',
+                                                     'operation', 'resources'])
+
+
+class OperationTimeout(Exception):
+    pass
+
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter: initial, initial * multiplier, ... up to ceiling seconds,
+    each delay randomly spread by +/- jitter (a fraction of the delay).
+    """
+    def __init__(self, initial=0.5, multiplier=1.5, ceiling=10.0, jitter=0.2, rand=random.random):
+        self.initial = initial
+        self.multiplier = multiplier
+        self.ceiling = ceiling
+        self.jitter = jitter
+        self.rand = rand
+        self.reset()
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next(self):
+        delay = min(self.delay, self.ceiling)
+        self.delay = min(self.delay * self.multiplier, self.ceiling)
+        return delay * (1 - self.jitter + 2 * self.jitter * self.rand())
+
+
+class OperationPoller(object):
+    """
+    Polls Deployment Manager operations until all of them are DONE.
+
+    get_operation (callable): Takes an operation name and returns the current operation
+                              resource, e.g. a wrapper around dm.operations().get(). Tests can
+                              pass a fake endpoint instead.
+    backoff (Backoff): Delay between polling rounds. It starts over whenever an operation
+                       changes, so active deployments are followed closely and idle ones
+                       don't burn API quota.
+    timeout (float): Raise OperationTimeout after this many seconds. None waits forever.
+    get_resources (callable): Takes an operation and returns [(resource name, state)] for the
+                              resources of its deployment, e.g. from dm.resources().list(). They
+                              are fetched along with every poll of the operation, and a resource
+                              changing state counts as a change of the operation. None only
+                              follows the operation's own status and progress.
+    sleep, clock: Injectable for tests.
+    """
+    def __init__(self, get_operation, backoff=None, timeout=None, get_resources=None, sleep=time.sleep,
+                 clock=time.time):
+        self.get_operation = get_operation
+        self.backoff = backoff or Backoff()
+        self.timeout = timeout
+        self.get_resources = get_resources
+        self.sleep = sleep
+        self.clock = clock
+
+    def poll(self, operations):
+        """
+        Yields an OperationProgress for the initial state of every operation and then every
+        time the status or progress of one of them changes, until all are DONE.
+        """
+        start = self.clock()
+        pending = {}
+        seen = {}
+        for operation in operations:
+            seen[operation['name']] = self.state(operation)
+            yield self.progress(operation, start)
+            if operation.get('status') != 'DONE':
+                pending[operation['name']] = operation
+
+        self.backoff.reset()
+        while pending:
+            if self.timeout is not None and self.clock() - start > self.timeout:
+                raise OperationTimeout('Operations still pending after {}s: {}'.format(
+                    self.timeout, ', '.join(sorted(pending))))
+            self.sleep(self.backoff.next())
+            changed = False
+            for name in list(pending):
+                operation, resources = self.fetch(name)
+                state = self.state(operation, resources)
+                if state != seen[name]:
+                    seen[name] = state
+                    changed = True
+                    yield self.progress(operation, start, resources)
+                if operation.get('status') == 'DONE':
+                    del pending[name]
+            if changed:
+                self.backoff.reset()
+
+    def wait(self, operations, callback=None):
+        """
+        Polls until all operations are DONE, calling callback with each OperationProgress.
+        Returns {operation name: final operation}.
+        """
+        finished = {}
+        for progress in self.poll(operations):
+            if callback is not None:
+                callback(progress)
+            finished[progress.name] = progress.operation
+        return finished
+
+    def fetch(self, name):
+        """Returns operation name as it is now, and its resources' states (see get_resources)."""
+        operation = self.get_operation(name)
+        if self.get_resources is None:
+            return operation, ()
+        return operation, tuple(self.get_resources(operation))
+
+    @staticmethod
+    def state(operation, resources=()):
+        """What has to change for an operation to be reported again."""
+        return operation.get('status'), operation.get('progress'), resources
+
+    def progress(self, operation, start, resources=()):
+        """Builds the OperationProgress for operation, with elapsed time since start."""
+        return OperationProgress(name=operation['name'],
+                                 target=operation.get('targetLink', '').split('/')[-1],
+                                 status=operation.get('status'),
+                                 progress=operation.get('progress', 0),
+                                 elapsed=self.clock() - start,
+                                 operation=operation,
+                                 resources=resources)
+
+
+def resource_state(resource):
+    """
+    The state of a Deployment Manager resource: the state of its pending update (PENDING,
+    IN_PROGRESS, FAILED, ...), or COMPLETED when it has none.
+    """
+    update = resource.get('update')
+    if update is None:
+        return 'COMPLETED'
+    return update.get('state', 'PENDING')
+
+
+def summarize_resources(resources):
+    """
+    A short description of [(resource name, state)]: the number of resources per state, and
+    the names of those in progress or failed.
+    """
+    counts = Counter(state for _, state in resources)
+    parts = ['{} {}'.format(count, state.lower().replace('_', ' ')) for state, count in sorted(counts.items())]
+    for state in ('IN_PROGRESS', 'FAILED'):
+        names = [name for name, s in resources if s == state]
+        if names:
+            parts.append('{}: {}'.format(state.lower().replace('_', ' '), ', '.join(names)))
+    return '; '.join(parts)
+
+
+def log_progress(progress):
+    """Default progress callback: one log line per change of an operation or of one of its resources."""
+    if progress.resources:
+        logger.info('[%6.1fs] %s: %s (%s%%) resources: %s', progress.elapsed, progress.target or progress.name,
+                    progress.status, progress.progress, summarize_resources(progress.resources))
+    else:
+        logger.info('[%6.1fs] %s: %s (%s%%)', progress.elapsed, progress.target or progress.name, progress.status,
+                    progress.progress)
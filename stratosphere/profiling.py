@@ -0,0 +1,113 @@
+"""
+Timers and counters for the hot paths of a stratosphere run: configuring templates, building and
+validating resources, serializing, and every Google API call.
+
+The profiler is off by default and then costs a single attribute check per hook. Enable it with
+the CLI's --profile flag, or with profiler.enable():
+
+    from stratosphere.profiling import profiler
+    profiler.enable()
+    ...
+    print(profiler.summary())
+    profiler.write_chrome_trace('stratosphere.trace.json')  # open in chrome://tracing or Perfetto
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        # {name: [calls, total seconds, max seconds]}
+        self.timers = {}
+        # Complete events for the Chrome trace
+        self.events = []
+        self.origin = self.clock()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, start, seconds, **args):
+        """Adds a measurement of seconds that started at start (a clock() value)."""
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            event = {'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6,
+                     'pid': os.getpid(), 'tid': threading.current_thread().ident}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    @contextmanager
+    def timer(self, name, **args):
+        """Times the with block as name. Does nothing while the profiler is disabled."""
+        if not self.enabled:
+            yield
+            return
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.record(name, start, self.clock() - start, **args)
+
+    def asObject(self):
+        return {
+            'timers': OrderedDict((name, {'calls': t[0], 'total': t[1], 'mean': t[1] / t[0], 'max': t[2]})
+                                  for name, t in sorted(self.timers.items(), key=lambda i: -i[1][1])),
+            'counters': OrderedDict(sorted(self.counters.items())),
+        }
+
+    def summary(self, limit=None):
+        """A table of the timers, slowest total first, followed by the counters."""
+        lines = ['{:<60} {:>8} {:>11} {:>10} {:>10}'.format('timer', 'calls', 'total ms', 'mean ms', 'max ms')]
+        timers = list(self.asObject()['timers'].items())
+        for name, t in timers[:limit]:
+            lines.append('{:<60} {:>8} {:>11.1f} {:>10.3f} {:>10.3f}'.format(
+                name, t['calls'], t['total'] * 1e3, t['mean'] * 1e3, t['max'] * 1e3))
+        if self.counters:
+            lines.append('')
+            lines.append('{:<60} {:>8}'.format('counter', 'count'))
+            for name, value in sorted(self.counters.items()):
+                lines.append('{:<60} {:>8}'.format(name, value))
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.asObject(), f, indent=2)
+            f.write('\n')
+
+    def write_chrome_trace(self, path):
+        """Writes the Trace Event Format understood by chrome://tracing and Perfetto."""
+        with self._lock:
+            events = list(self.events)
+        end = (self.clock() - self.origin) * 1e6
+        events.extend({'name': name, 'ph': 'C', 'ts': end, 'pid': os.getpid(), 'args': {'count': value}}
+                      for name, value in sorted(self.counters.items()))
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# The process-wide profiler the hooks report to
+profiler = Profiler()
@@ -0,0 +1,141 @@
+import re
+from collections import OrderedDict
+
+# $(ref.<name>.<field>) as understood by Deployment Manager
+REF_PATTERN = re.compile(r'\$\(ref\.([^.)]+)[.)]')
+
+
+def iter_strings(obj):
+    """Yields every string in a serialized (asObject()) structure."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+
+
+def ref_names(value):
+    """Names of the resources referenced with $(ref.<name>...) in a string."""
+    return REF_PATTERN.findall(value)
+
+
+# A resource URL, full or starting at projects/: projects/<project>/global/networks/<name>,
+# .../regions/<region>/subnetworks/<name>, .../zones/<zone>/instances/<name>, ...
+URL_PATTERN = re.compile(r'(?:^|/)projects/[^/]+/(?:global|(?:regions|zones|locations)/[^/]+)/([A-Za-z]+)/([^/]+)$')
+
+
+def url_collection(resource_type):
+    """
+    The collection resources of a Deployment Manager type appear under in URLs, e.g.
+    compute.v1.network -> networks, compute.v1.globalAddress -> addresses.
+    """
+    kind = re.split(r'[.#]', resource_type)[-1]
+    for scope in ('global', 'region'):
+        if kind.startswith(scope) and kind[len(scope):len(scope) + 1].isupper():
+            kind = kind[len(scope)].lower() + kind[len(scope) + 1:]
+    if kind.endswith('ss'):
+        return kind + 'es'
+    return kind if kind.endswith('s') else kind + 's'
+
+
+def url_names(obj):
+    """
+    Returns the set of (collection, name) a serialized structure points at with resource URLs
+    like projects/<project>/global/networks/<name>. Strings with a $(ref) are skipped,
+    Deployment Manager resolves those within the same deployment.
+    """
+    names = set()
+    for value in iter_strings(obj):
+        if '/' in value and '$(ref.' not in value:
+            match = URL_PATTERN.search(value.rstrip('/'))
+            if match:
+                names.add(match.groups())
+    return names
+
+
+class ReferenceGraph(object):
+    """
+    The name index and $(ref) graph of a config's serialized resources. Building it and all of
+    its checks take time linear in the size of the config.
+
+    Only $(ref.<name>...) references are checked: Deployment Manager resolves those within the
+    deployment, while hand-built URLs may point at resources of other deployments.
+    """
+    def __init__(self, resources):
+        # {name: serialized resource}, the first one if the name is used more than once
+        self.index = OrderedDict()
+        self.duplicates = []
+        # {name: OrderedDict of the names it references}
+        self.references = OrderedDict()
+        for resource in resources:
+            name = resource.get('name')
+            if name in self.index:
+                self.duplicates.append(name)
+            else:
+                self.index[name] = resource
+            refs = self.references.setdefault(name, OrderedDict())
+            for value in iter_strings(resource):
+                if '$(ref.' in value:
+                    for ref in ref_names(value):
+                        refs[ref] = None
+
+    def dangling(self):
+        """(name, referenced name) for every $(ref) to a resource that isn't in the config."""
+        return [(name, ref) for name, refs in self.references.items() for ref in refs if ref not in self.index]
+
+    def cycles(self):
+        """
+        Returns every reference cycle as a list of resource names, using an iterative version of
+        Tarjan's strongly connected components algorithm.
+        """
+        order = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+
+        def visit(node):
+            order[node] = low[node] = len(order)
+            stack.append(node)
+            on_stack.add(node)
+            return node, iter([r for r in self.references[node] if r in self.index])
+
+        for root in self.references:
+            if root in order:
+                continue
+            work = [visit(root)]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in order:
+                        work.append(visit(child))
+                        break
+                    elif child in on_stack:
+                        low[node] = min(low[node], order[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == order[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1 or node in self.references[node]:
+                            cycles.append(component[::-1])
+        return cycles
+
+    def problems(self):
+        """Human readable descriptions of duplicate names, dangling references and cycles."""
+        problems = ['Duplicate resource name: {}'.format(name) for name in self.duplicates]
+        problems.extend('{} references missing resource {}'.format(name, ref) for name, ref in self.dangling())
+        problems.extend('Reference cycle: {}'.format(' -> '.join(cycle + cycle[:1])) for cycle in self.cycles())
+        return problems
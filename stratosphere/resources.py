@@ -1,13 +1,66 @@
+import copy
 import hashlib
 import inspect
 import logging
-import yaml
+import weakref
 import json
 
+try:
+    from stratosphere.profiling import profiler
+    from stratosphere.references import ReferenceGraph
+    from stratosphere.serialization import dump_json, dump_sharded, dump_yaml
+except ImportError:
+    # Python2
+    from profiling import profiler
+    from references import ReferenceGraph
+    from serialization import dump_json, dump_sharded, dump_yaml
+
 logger = logging.getLogger(__name__)
 
+# Immutable values that can be compared cheaply to skip cache invalidation on no-op assignments
+_SCALAR_TYPES = (str, bytes, bool, int, float)
+
+# Log level below DEBUG for per-value validation output, enabled with -vv
+TRACE = 5
+
+_validator_descriptions = {}
+
+
+def describe_validator(validator):
+    """
+    Returns the source of a validator function for log and error messages. The source is
+    only read from disk once per validator.
+    """
+    try:
+        return _validator_descriptions[validator]
+    except KeyError:
+        pass
+    try:
+        description = inspect.getsource(validator)
+    except (IOError, OSError, TypeError):
+        description = repr(validator)
+    _validator_descriptions[validator] = description
+    return description
+
+
+class LazyValidatorSource(object):
+    """
+    Log argument that only resolves the validator's source when the record is formatted,
+    i.e. when TRACE logging is actually enabled.
+    """
+    __slots__ = ('validator', )
+
+    def __init__(self, validator):
+        self.validator = validator
+
+    def __str__(self):
+        return describe_validator(self.validator)
+
+
 class Template(object):
     TEMPLATE_TYPE = None  # Need to override this in subclasses
+    DEPENDS_ON = ()  # TEMPLATE_TYPEs of templates that must be deployed before this one
+    CHECK_REFERENCES = True  # Reject duplicate names, dangling $(ref)s and reference cycles when rendering
 
     def __init__(self, project, env):
         self.project = project
@@ -16,6 +69,14 @@ class Template(object):
         self.resources = []
         self.configured = False
         self.formatter = self.asYAML
+        # Worker processes used to render large templates as YAML, see serialization.dump_sharded.
+        # None renders in this process. JSON is always rendered in this process, the C encoder
+        # is faster than sending the resources to a worker.
+        self.render_processes = None
+        # Rendered config and its hash, cleared by _invalidate() whenever a resource changes
+        self._object = None
+        self._rendered = {}
+        self._config_hash = None
 
         if self.TEMPLATE_TYPE is None:
             raise NotImplementedError('Must set constant TEMPLATE_TYPE in Template Subclass. Example: network')
@@ -26,33 +87,216 @@ class Template(object):
 
     def add_resource(self, resource):
         self.resources.append(resource)
+        # Resources invalidate their parents when they change, see BaseGCPResource._invalidate
+        resource._parents[id(self)] = weakref.ref(self)
+        self._invalidate()
+
+    def _invalidate(self):
+        """
+        Drops the cached rendering. Resources should be added with add_resource so their changes
+        reach the template, appending to self.resources directly bypasses invalidation.
+        """
+        self._object = None
+        self._rendered = {}
+        self._config_hash = None
+
+    def __getstate__(self):
+        # The caches are rebuilt after unpickling or copying
+        state = self.__dict__.copy()
+        state.update(_object=None, _rendered={}, _config_hash=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for resource in self.resources:
+            resource._parents[id(self)] = weakref.ref(self)
 
     def configure(self):
         raise NotImplementedError("Subclass Template and override configure()!")
 
+    def ensure_configured(self):
+        if not self.configured:
+            with profiler.timer('configure:{}'.format(self.name)):
+                self.configure()
+            self.configured = True
+
+    def asObject(self):
+        """The config as a dict, cached until a resource changes. Treat it as read-only."""
+        if self._object is None:
+            with profiler.timer('asObject:{}'.format(self.name), resources=len(self.resources)):
+                _object = {'resources': [r.asObject() for r in self.resources]}
+            if self.CHECK_REFERENCES:
+                self.check_references(_object['resources'])
+            self._object = _object
+        return self._object
+
+    def check_references(self, resources=None):
+        """
+        Raises ValueError if resources (by default this template's) have duplicate names,
+        $(ref)s to resources that aren't in the template, or reference cycles. Deployment
+        Manager would only reject those after the deployment was submitted.
+        """
+        if resources is None:
+            resources = [r.asObject() for r in self.resources]
+        with profiler.timer('check_references:{}'.format(self.name)):
+            problems = ReferenceGraph(resources).problems()
+        if problems:
+            raise ValueError('Template {} has invalid references:\n  {}'.format(self.name, '\n  '.join(problems)))
+
+    def config_hash(self):
+        """
+        Returns a SHA-1 hex digest of the rendered config. Key order and output format don't
+        affect it, so it only changes when the config Deployment Manager would get changes.
+        """
+        self.ensure_configured()
+        if self._config_hash is None:
+            with profiler.timer('config_hash:{}'.format(self.name)):
+                self._config_hash = hashlib.sha1(json.dumps(self.asObject(), sort_keys=True, separators=(',', ':'),
+                                                            default=str).encode('utf-8')).hexdigest()
+        return self._config_hash
+
+    def _render(self, format, dump):
+        try:
+            return self._rendered[format]
+        except KeyError:
+            pass
+        logger.debug('Rendering %s as %s', self.name, format)
+        document = self.asObject()
+        with profiler.timer('render.{}:{}'.format(format, self.name)):
+            if self.render_processes and format == 'yaml':
+                rendered = dump_sharded(document['resources'], format, processes=self.render_processes)
+            else:
+                rendered = dump(document)
+        self._rendered[format] = rendered
+        return rendered
+
     def asYAML(self):
-        return yaml.safe_dump({'resources': [r.asObject() for r in self.resources]})
+        return self._render('yaml', dump_yaml)
 
     def asJSON(self):
-        return json.dumps({'resources': [r.asObject() for r in self.resources]})
+        return self._render('json', dump_json)
+
+    def render_to(self, stream, format='yaml'):
+        """
+        Writes the template to stream (a file, sys.stdout, ...) one resource at a time instead
+        of building the whole document in memory first. The output is identical to asYAML()
+        or asJSON(), which are used as is if they were already rendered. With render_processes
+        set, YAML is rendered through asYAML().
+        """
+        self.ensure_configured()
+        if self.CHECK_REFERENCES:
+            # Fail before anything is written
+            self.asObject()
+        with profiler.timer('render_to.{}:{}'.format(format, self.name)):
+            self._render_to(stream, format)
+
+    def _render_to(self, stream, format):
+        if format in self._rendered or (self.render_processes and format == 'yaml'):
+            stream.write(self.asYAML() if format == 'yaml' else self.asJSON())
+        elif format == 'yaml':
+            if not self.resources:
+                stream.write(self.asYAML())
+                return
+            # Block sequences under a mapping key aren't indented, so each resource dumped as
+            # a one-item list is exactly its part of the full document.
+            stream.write('resources:\n')
+            for resource in self.resources:
+                dump_yaml([resource.asObject()], stream)
+        elif format == 'json':
+            stream.write('{"resources": [')
+            for i, resource in enumerate(self.resources):
+                if i:
+                    stream.write(', ')
+                dump_json(resource.asObject(), stream)
+            stream.write(']}')
+        else:
+            raise ValueError('Unsupported template format: {}'.format(format))
 
     def __repr__(self):
-        if not self.configured:
-            self.configure()
-            self.configured = True
+        self.ensure_configured()
         return str(self.formatter())
 
 
-class BaseGCPResource(object):
+class PropertySpec(object):
+    """
+    The pre-resolved validation rules for one entry of a props schema:
+
+        'key': (<type or [types]>, <required bool>, <optional validator function or allowed values>)
+
+    Specs are built once per class by PropsMeta, so _set_property doesn't have to
+    re-interpret the raw props tuple on every assignment.
+    """
+    __slots__ = ('key', 'expected_type', 'required', 'is_list', 'types', 'validator',
+                 'allowed_values', 'allowed_repr')
+
+    def __init__(self, key, definition):
+        self.key = key
+        self.expected_type = definition[0]
+        self.required = definition[1]
+        self.is_list = isinstance(self.expected_type, list)
+        self.types = tuple(self.expected_type) if self.is_list else self.expected_type
+        self.validator = None
+        self.allowed_values = None
+        self.allowed_repr = None
+        if len(definition) > 2:
+            allowed_values = definition[2]
+            if hasattr(allowed_values, '__call__'):
+                self.validator = allowed_values
+            else:
+                # ranges already have O(1) membership tests, anything else gets frozen into a set
+                self.allowed_values = allowed_values if isinstance(allowed_values, range) \
+                    else frozenset(allowed_values)
+                self.allowed_repr = allowed_values
+
+    def allows(self, value):
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return all(v in self.allowed_values for v in value)
+        return value in self.allowed_values
+
+
+class PropsMeta(type):
+    """
+    Compiles the props schema of every GCPResource/GCPProperty subclass into a
+    {key: PropertySpec} plan when the class is created. Reassigning props on the
+    class recompiles the plan.
+    """
+    def __init__(cls, name, bases, namespace):
+        super(PropsMeta, cls).__init__(name, bases, namespace)
+        cls._compile_props()
+
+    def __setattr__(cls, key, value):
+        super(PropsMeta, cls).__setattr__(key, value)
+        if key == 'props':
+            cls._compile_props()
+
+    def _compile_props(cls):
+        props = getattr(cls, 'props', None) or {}
+        plan = dict((k, PropertySpec(k, v)) for k, v in props.items())
+        type.__setattr__(cls, '_props_plan', plan)
+        type.__setattr__(cls, '_required_props', tuple(k for k, spec in plan.items() if spec.required))
+
+
+# Equivalent to `class BaseGCPResource(object, metaclass=PropsMeta)`, but also valid in Python2
+_PropsBase = PropsMeta('_PropsBase', (object, ), {})
+
+
+class BaseGCPResource(_PropsBase):
     # The cluster API is different from the other GCP APIs.  Doesn't accept a 'name' field
     # as a property field. Sigh google.
     INCLUDE_NAME_PROPERTY = True
 
     def __init__(self, **kwargs):
         self.properties = {}
+        # Serialized form and content fingerprint of this object, cleared by _invalidate()
+        self._object = None
+        self._fingerprint = None
+        # Objects that hold this one as a property value, as {id(parent): weakref(parent)}
+        self._parents = {}
+        if profiler.enabled:
+            profiler.count('construct.' + self.__class__.__name__)
         for k, v in kwargs.items():
-            logger.debug("Setting property {}".format(k))
-            logger.log(5, "Property value: {}".format(v))
+            logger.debug("Setting property %s", k)
+            logger.log(TRACE, "Property value: %s", v)
             self._set_property(k, v)
 
     @property
@@ -63,55 +307,139 @@ class BaseGCPResource(object):
     def Ref(self):
         return str('$(ref.{}.selfLink)'.format(self.name))
 
+    def fingerprint(self):
+        """
+        Returns a deterministic SHA-1 hex digest of this object's class and all of its
+        properties, including nested resources/properties. It is cached until the object or
+        one of its children changes through _set_property.
+        """
+        if self._fingerprint is None:
+            hasher = hashlib.sha1()
+            hasher.update('{}.{}'.format(self.__class__.__module__, self.__class__.__name__).encode('utf-8'))
+            hasher.update(json.dumps(self._canonical(self.properties), sort_keys=True, separators=(',', ':'),
+                                     default=self._canonical_default).encode('utf-8'))
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
+    @classmethod
+    def _canonical(cls, value):
+        # Nested objects contribute their own (cached) fingerprint instead of their full contents
+        if isinstance(value, BaseGCPResource):
+            return {'__fingerprint__': value.fingerprint()}
+        if isinstance(value, (list, tuple)):
+            return [cls._canonical(v) for v in value]
+        if isinstance(value, dict):
+            return dict((k, cls._canonical(v)) for k, v in value.items())
+        return value
+
+    @staticmethod
+    def _canonical_default(value):
+        if isinstance(value, bytes):
+            return {'__bytes__': value.hex()}
+        return repr(value)
+
+    def __eq__(self, other):
+        if not isinstance(other, BaseGCPResource):
+            return NotImplemented
+        return self.__class__ is other.__class__ and self.fingerprint() == other.fingerprint()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
     def __hash__(self):
-        # Make a unique name for the resource
-        hasher = hashlib.md5()
-        hasher.update(''.join([v for v in self.asObject().values() if
-                               isinstance(v, str)]).encode('utf-8'))
-        return hasher.hexdigest()
+        # Resources are hashed by content so duplicates collapse in sets and dicts. Don't change
+        # a resource while it's used as a key, since that changes its hash.
+        return int(self.fingerprint()[:16], 16)
 
     def _set_property(self, key, value):
         if value is None: return
-        if key not in self.props.keys():
+        if profiler.enabled:
+            profiler.count('set_property.' + self.__class__.__name__)
+        spec = self._props_plan.get(key)
+        if spec is None:
             type_name = getattr(self, 'resource_type', self.__class__.__name__)
             raise AttributeError('{} object does not support attribute {}'.format(type_name, key))
-        expected_type = self.props[key][0]
         # The third field in a property is a validator function or a valid list of values
-        if len(self.props[key]) == 3:
-            allowed_values = self.props[key][2]
-            # We turn the string into a set of 1 so we can do set comparison below
-            _value_set = set([value]) if isinstance(value, str) else set(value)
-            # allowed_values is a validator function
-            if hasattr(allowed_values, '__call__'):
-                if isinstance(value, list):
-                    # validate a list of items (if item is a list)
-                    logger.debug("Validating list of items for key={}".format(key))
-                    for v in value:
-                        logger.log(5, "Validating key='{}', value='{}' against validator function:\n{}"\
-                            .format(key, v, inspect.getsource(allowed_values)))
-                        if not allowed_values(v):
-                            self._raise_value(key, v, allowed_values)
-                else:
-                    # validate single item
-                    logger.debug("Validating item for key={}".format(key))
-                    logger.log(5, "Validating key='{}', value='{}' against validator function:\n{}"\
-                        .format(key, value,inspect.getsource(allowed_values)))
-                    if not allowed_values(value):
-                        self._raise_value(key, value, allowed_values)
-            # allowed_values is a set of valid strings
-            elif not (_value_set <= set(allowed_values)):
-                self._raise_value(key, value, allowed_values)
-        if isinstance(expected_type, list):
+        if spec.validator is not None:
+            trace = logger.isEnabledFor(TRACE)
+            if isinstance(value, list):
+                # validate a list of items (if item is a list)
+                logger.debug("Validating list of items for key=%s", key)
+                for v in value:
+                    if trace:
+                        logger.log(TRACE, "Validating key='%s', value='%s' against validator function:\n%s",
+                                   key, v, LazyValidatorSource(spec.validator))
+                    if not spec.validator(v):
+                        self._raise_value(key, v, spec.validator)
+            else:
+                # validate single item
+                logger.debug("Validating item for key=%s", key)
+                if trace:
+                    logger.log(TRACE, "Validating key='%s', value='%s' against validator function:\n%s",
+                               key, value, LazyValidatorSource(spec.validator))
+                if not spec.validator(value):
+                    self._raise_value(key, value, spec.validator)
+        # allowed_values is a set of valid values
+        elif spec.allowed_values is not None and not spec.allows(value):
+            self._raise_value(key, value, spec.allowed_repr)
+        if spec.is_list:
             if not isinstance(value, list):
-                self._raise_type(key, value, expected_type)
+                self._raise_type(key, value, spec.expected_type)
             for v in value:
-                if not isinstance(v, tuple(expected_type)):
-                    self._raise_type(key, v, expected_type)
-            return self.properties.__setitem__(key, value)
-        elif isinstance(value, expected_type):
-            return self.properties.__setitem__(key, value)
-        else:
-            self._raise_type(key, value, expected_type)
+                if not isinstance(v, spec.types):
+                    self._raise_type(key, v, spec.expected_type)
+        elif not isinstance(value, spec.types):
+            self._raise_type(key, value, spec.expected_type)
+        old_value = self.properties.get(key)
+        self.properties[key] = value
+        if isinstance(value, _SCALAR_TYPES) and type(old_value) is type(value) and old_value == value:
+            return
+        self._adopt(value)
+        self._invalidate()
+
+    def __getstate__(self):
+        # Weak references can't be pickled, and a copy's caches and parents are its own. Parents
+        # register themselves again in __setstate__.
+        state = self.__dict__.copy()
+        state.update(_object=None, _fingerprint=None, _parents={})
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for value in self.properties.values():
+            self._adopt(value)
+
+    def __deepcopy__(self, memo):
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        copied.__setstate__(copy.deepcopy(self.__getstate__(), memo))
+        return copied
+
+    def _adopt(self, value):
+        """Registers self as the parent of any resources/properties contained in value."""
+        children = value if isinstance(value, list) else (value, )
+        for child in children:
+            if isinstance(child, BaseGCPResource):
+                child._parents[id(self)] = weakref.ref(self)
+
+    def _invalidate(self):
+        """
+        Drops the cached serialization of this object and of every object that contains it.
+
+        Parents only ever cache a serialization or fingerprint built from their children's
+        caches, so if this object has nothing cached there's nothing stale further up either.
+        Changes must go through _set_property: mutating self.properties (or a list stored in
+        it) in place bypasses invalidation.
+        """
+        if self._object is None and self._fingerprint is None:
+            return
+        self._object = None
+        self._fingerprint = None
+        for parent_ref in list(self._parents.values()):
+            parent = parent_ref()
+            if parent is not None:
+                parent._invalidate()
 
     def _raise_type(self, key, value, expected_type):
         raise TypeError("{}: {}.{} is {}, expected {}".format(self.__class__,
@@ -122,12 +450,24 @@ class BaseGCPResource(object):
 
     def _raise_value(self, key, value, allowed_values):
         if hasattr(allowed_values, '__call__'):
-            allowed_values = 'defined in function:\n{}'.format(inspect.getsource(allowed_values))
+            allowed_values = 'defined in function:\n{}'.format(describe_validator(allowed_values))
         raise TypeError("{}: Property \'{}\' is set to \'{}\', expected values {}".format(self.__class__,
                                                                                           key,
                                                                                           value,
                                                                                           allowed_values))
 
+    def asObject(self):
+        """
+        Returns the serialized (dict) form of this object. The result is cached until a
+        property of this object or one of its children changes, so treat it as read-only.
+        """
+        if self._object is None:
+            self._object = self._buildObject()
+        return self._object
+
+    def _buildObject(self):
+        raise NotImplementedError
+
     def _toObject(self):
         if self.isValid():
             _object = {}
@@ -150,14 +490,16 @@ class BaseGCPResource(object):
 
 
     def isValid(self):
+        if profiler.enabled:
+            with profiler.timer('isValid.' + self.__class__.__name__):
+                return self._isValid()
+        return self._isValid()
+
+    def _isValid(self):
         if isinstance(self, GCPResource) and not hasattr(self, 'resource_type'):
             raise ValueError("Resource {} requires a resource_type.".format(self.name))
-        for k, v in self.props.items():
-            prop_type = v[0]
-            required = v[1]
-            if len(v) > 2:
-                allowed_values = v[2]
-            if required and k not in self.properties:
+        for k in self._required_props:
+            if k not in self.properties:
                 raise ValueError("Resource {} required in type {}".format(k, self.__class__))
         # Finally, run extra validators if they are defined
         if getattr(self, 'validator', None):
@@ -166,7 +508,7 @@ class BaseGCPResource(object):
 
 
 class GCPResource(BaseGCPResource):
-    def asObject(self):
+    def _buildObject(self):
         return {
             'type': self.resource_type,
             'name': self.name,
@@ -192,6 +534,6 @@ class GCPProperty(BaseGCPResource):
         ...
     }
     """
-    def asObject(self):
+    def _buildObject(self):
         return self._toObject()
 
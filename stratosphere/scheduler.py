@@ -0,0 +1,186 @@
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from stratosphere.operations import OperationTimeout
+    from stratosphere.references import url_collection, url_names
+except ImportError:
+    # Python2
+    from operations import OperationTimeout
+    from references import url_collection, url_names
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyGraph(object):
+    """
+    Ordering constraints between deployments.
+
+    dependencies (dict): {deployment name: names of the deployments it depends on}. Names that
+                         aren't keys of dependencies themselves are ignored, e.g. deployments
+                         that already exist and aren't part of this run.
+    """
+    def __init__(self, dependencies):
+        self.dependencies = OrderedDict()
+        for name, deps in dependencies.items():
+            self.dependencies[name] = set(d for d in deps if d in dependencies and d != name)
+        self._order = self._topological_order()
+
+    @classmethod
+    def from_templates(cls, templates):
+        """
+        Builds the graph between templates (keyed by template name). A template depends on
+        another if it lists the other's TEMPLATE_TYPE in DEPENDS_ON, or if one of its resources
+        points at one of the other template's resources by a URL like
+        projects/<project>/global/networks/<name>, matching both its collection and name.
+        $(ref.<name>...) can't cross deployments, Template.check_references rejects those.
+        """
+        owners = {}
+        types = {}
+        for template in templates:
+            if template.name in types.values():
+                raise ValueError('Template {} was given more than once'.format(template.name))
+            types[template.TEMPLATE_TYPE] = template.name
+            template.ensure_configured()
+            for resource in template.resources:
+                owners[(url_collection(resource.resource_type), resource.name)] = template.name
+
+        dependencies = OrderedDict()
+        for template in templates:
+            deps = set(types[t] for t in template.DEPENDS_ON if t in types)
+            for resource in template.resources:
+                for collection, name in url_names(resource.asObject()):
+                    owner = owners.get((collection, name))
+                    if owner is not None and owner != template.name:
+                        logger.debug('%s depends on %s through a URL of %s/%s', template.name, owner, collection,
+                                     name)
+                        deps.add(owner)
+            dependencies[template.name] = deps
+        return cls(dependencies)
+
+    def reversed(self):
+        """The graph with every edge flipped, e.g. to tear deployments down."""
+        dependents = OrderedDict((name, set()) for name in reversed(self._order))
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                dependents[dep].add(name)
+        return DependencyGraph(dependents)
+
+    def order(self):
+        """Deployment names, each one after all of its dependencies."""
+        return list(self._order)
+
+    def _topological_order(self):
+        # Kahn's algorithm, keeping the given order among independent deployments
+        remaining = OrderedDict((name, set(deps)) for name, deps in self.dependencies.items())
+        order = []
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError('Dependency cycle between deployments: {}'.format(
+                    ', '.join('{} -> {}'.format(name, '/'.join(sorted(deps))) for name, deps in remaining.items())))
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+            order.extend(ready)
+        return order
+
+
+class DeploymentScheduler(object):
+    """
+    Runs deployments in dependency order: every deployment whose dependencies have finished is
+    submitted, with at most max_workers operations in flight, and all in-flight operations are
+    polled together.
+
+    graph (DependencyGraph): The deployments to run and their ordering
+    submit (callable): Takes a deployment name and returns the operation it started, or None if
+                       there was nothing to do for that deployment
+    poller (OperationPoller): Provides fetch, backoff and the sleep/clock functions
+    callback (callable): Receives an OperationProgress for every change of an operation
+    """
+    def __init__(self, graph, submit, poller, max_workers=4, callback=None):
+        self.graph = graph
+        self.submit = submit
+        self.poller = poller
+        self.max_workers = max_workers
+        self.callback = callback
+        self.results = OrderedDict()
+        self.failed = OrderedDict()
+        self.skipped = []
+
+    def run(self):
+        """
+        Returns {deployment name: final operation (None if nothing was submitted)} for every
+        deployment that finished. Failures are in self.failed ({name: operation or exception}),
+        and deployments that depend on a failure are in self.skipped.
+        """
+        remaining = self.graph.order()
+        in_flight = OrderedDict()
+        seen = {}
+        start = self.poller.clock()
+        backoff = self.poller.backoff
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while remaining or in_flight:
+                ready = []
+                for name in list(remaining):
+                    deps = self.graph.dependencies[name]
+                    if any(d in self.failed or d in self.skipped for d in deps):
+                        logger.error('Skipping %s, a deployment it depends on failed', name)
+                        self.skipped.append(name)
+                        remaining.remove(name)
+                    elif all(d in self.results for d in deps) and len(in_flight) + len(ready) < self.max_workers:
+                        ready.append(name)
+                        remaining.remove(name)
+
+                futures = [(name, pool.submit(self.submit, name)) for name in ready]
+                for name, future in futures:
+                    try:
+                        operation = future.result()
+                    except Exception as e:
+                        logger.error('Submitting %s failed: %s', name, e)
+                        self.failed[name] = e
+                        continue
+                    if operation is None:
+                        self.results[name] = None
+                        continue
+                    seen[operation['name']] = self.poller.state(operation)
+                    self._report(operation, start)
+                    if operation.get('status') == 'DONE':
+                        self._finish(name, operation)
+                    else:
+                        in_flight[operation['name']] = name
+
+                if not in_flight:
+                    if remaining and not ready:
+                        raise RuntimeError('Deployments can never be scheduled: {}'.format(', '.join(remaining)))
+                    continue
+
+                if self.poller.timeout is not None and self.poller.clock() - start > self.poller.timeout:
+                    raise OperationTimeout('Operations still pending after {}s: {}'.format(
+                        self.poller.timeout, ', '.join(in_flight.values())))
+                self.poller.sleep(backoff.next())
+                changed = False
+                for operation, resources in pool.map(self.poller.fetch, list(in_flight)):
+                    state = self.poller.state(operation, resources)
+                    if state != seen[operation['name']]:
+                        seen[operation['name']] = state
+                        changed = True
+                        self._report(operation, start, resources)
+                    if operation.get('status') == 'DONE':
+                        self._finish(in_flight.pop(operation['name']), operation)
+                if changed:
+                    backoff.reset()
+        return self.results
+
+    def _report(self, operation, start, resources=()):
+        if self.callback is not None:
+            self.callback(self.poller.progress(operation, start, resources))
+
+    def _finish(self, name, operation):
+        if operation.get('error'):
+            self.failed[name] = operation
+        else:
+            self.results[name] = operation
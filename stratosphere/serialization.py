@@ -0,0 +1,196 @@
+"""
+YAML and JSON serialization backends.
+
+YAML is emitted and parsed with libyaml's C implementation when PyYAML was built against it,
+and falls back to the pure Python implementation otherwise. JSON is parsed with orjson,
+ujson or simplejson if one of them is installed. JSON is always encoded with the standard
+library's C encoder, since the faster libraries format their output differently.
+
+Every backend produces byte-identical output, verify_backends() checks that for a given
+document. A backend can be forced with the STRATOSPHERE_YAML_BACKEND and
+STRATOSPHERE_JSON_BACKEND environment variables or with set_backends().
+
+dump_sharded() renders large configs in several processes, with the same output.
+"""
+import importlib
+import io
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Line width for YAML output. libyaml and the pure Python emitter fold long scalars
+# differently, so long lines are never folded to keep the output the same with either.
+YAML_WIDTH = 1 << 30
+
+
+class _NoAliases(object):
+    """
+    Never emit &anchors/*aliases. Resources hand out cached dicts from asObject(), so the
+    same object can legitimately appear in several places of one template.
+    """
+    def ignore_aliases(self, data):
+        return True
+
+
+class PythonYAMLDumper(_NoAliases, yaml.SafeDumper):
+    pass
+
+
+YAML_BACKENDS = {
+    'python': (PythonYAMLDumper, yaml.SafeLoader),
+}
+
+if getattr(yaml, '__with_libyaml__', False):
+    class LibYAMLDumper(_NoAliases, yaml.CSafeDumper):
+        pass
+
+    YAML_BACKENDS['libyaml'] = (LibYAMLDumper, yaml.CSafeLoader)
+
+
+def _json_loader(module_name):
+    try:
+        return importlib.import_module(module_name).loads
+    except ImportError:
+        return None
+
+
+JSON_BACKENDS = {'json': json.loads}
+for _name in ('orjson', 'ujson', 'simplejson'):
+    _loads = _json_loader(_name)
+    if _loads is not None:
+        JSON_BACKENDS[_name] = _loads
+
+_backends = {}
+
+
+def _pick(backends, preferred, env_var):
+    forced = os.environ.get(env_var)
+    if forced:
+        if forced not in backends:
+            raise ValueError('{}={} is not available, choose from: {}'.format(env_var, forced,
+                                                                             ', '.join(sorted(backends))))
+        return forced
+    for name in preferred:
+        if name in backends:
+            return name
+
+
+def set_backends(yaml_backend=None, json_backend=None):
+    """
+    Selects the YAML and JSON backends by name. None picks the fastest available one,
+    unless it's forced through the environment.
+    """
+    yaml_backend = yaml_backend or _pick(YAML_BACKENDS, ('libyaml', 'python'), 'STRATOSPHERE_YAML_BACKEND')
+    json_backend = json_backend or _pick(JSON_BACKENDS, ('orjson', 'ujson', 'simplejson', 'json'),
+                                         'STRATOSPHERE_JSON_BACKEND')
+    if yaml_backend not in YAML_BACKENDS:
+        raise ValueError('Unknown YAML backend: {}'.format(yaml_backend))
+    if json_backend not in JSON_BACKENDS:
+        raise ValueError('Unknown JSON backend: {}'.format(json_backend))
+    _backends['yaml'] = yaml_backend
+    _backends['json'] = json_backend
+    logger.debug('Serialization backends: yaml=%s, json=%s', yaml_backend, json_backend)
+
+
+def get_backends():
+    return dict(_backends)
+
+
+def dump_yaml(data, stream=None, backend=None):
+    """Dumps data as block-style YAML, to stream if given, otherwise returns it as a string."""
+    dumper = YAML_BACKENDS[backend or _backends['yaml']][0]
+    return yaml.dump(data, stream, Dumper=dumper, width=YAML_WIDTH)
+
+
+def load_yaml(stream, backend=None):
+    loader = YAML_BACKENDS[backend or _backends['yaml']][1]
+    return yaml.load(stream, Loader=loader)
+
+
+def dump_json(data, stream=None):
+    """Dumps data as JSON, to stream if given, otherwise returns it as a string."""
+    if stream is None:
+        return json.dumps(data)
+    stream.write(json.dumps(data))
+
+
+def load_json(text, backend=None):
+    return JSON_BACKENDS[backend or _backends['json']](text)
+
+
+# Smallest number of resources per shard for dump_sharded(). Below this, pickling the shard to
+# a worker process costs about as much as dumping it.
+MIN_SHARD_SIZE = 250
+
+
+def _dump_shard(args):
+    format, items, yaml_backend = args
+    if format == 'yaml':
+        return dump_yaml(items, backend=yaml_backend)
+    # Strip the list's brackets, shards are joined into one list again
+    return json.dumps(items)[1:-1]
+
+
+def dump_sharded(resources, format='yaml', processes=None, shard_size=None):
+    """
+    Dumps {'resources': resources} in several worker processes. The output is byte-identical
+    to dump_yaml()/dump_json() of the same document: resources are split into shards, each
+    shard is dumped as a list in a worker, and the pieces are joined in order.
+
+    processes (int): Worker processes, None for one per CPU
+    shard_size (int): Resources per shard, by default enough for about 4 shards per process
+                      but at least MIN_SHARD_SIZE
+
+    Falls back to dumping in this process when there's only a single shard.
+    """
+    if format not in ('yaml', 'json'):
+        raise ValueError('Unsupported format: {}'.format(format))
+    processes = processes or os.cpu_count() or 1
+    if shard_size is None:
+        shard_size = max(MIN_SHARD_SIZE, -(-len(resources) // (processes * 4)))
+    if processes < 2 or len(resources) <= shard_size:
+        document = {'resources': resources}
+        return dump_yaml(document) if format == 'yaml' else dump_json(document)
+
+    shards = [(format, resources[i:i + shard_size], _backends['yaml'])
+              for i in range(0, len(resources), shard_size)]
+    logger.debug('Dumping %d resources as %s in %d shards on %d processes', len(resources), format, len(shards),
+                 processes)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        pieces = list(pool.map(_dump_shard, shards))
+    # Block sequences under a mapping key aren't indented, so the shards' top-level lists
+    # concatenate into the value of resources.
+    if format == 'yaml':
+        return 'resources:\n' + ''.join(pieces)
+    return '{"resources": [' + ', '.join(pieces) + ']}'
+
+
+def verify_backends(data):
+    """
+    Renders data with every available backend and checks the results are identical: the YAML
+    output byte for byte, and what each JSON parser reads back from the JSON output.
+
+    Returns a list of mismatch descriptions, which is empty if all backends agree.
+    """
+    mismatches = []
+    rendered = dict((name, dump_yaml(data, backend=name)) for name in YAML_BACKENDS)
+    reference = rendered['python']
+    for name, output in rendered.items():
+        if output != reference:
+            mismatches.append('YAML backend {} output differs from python'.format(name))
+        if load_yaml(io.StringIO(output), backend=name) != load_yaml(reference, backend='python'):
+            mismatches.append('YAML backend {} does not round-trip'.format(name))
+    json_output = dump_json(data)
+    expected = json.loads(json_output)
+    for name in JSON_BACKENDS:
+        if load_json(json_output, backend=name) != expected:
+            mismatches.append('JSON backend {} parses differently from json'.format(name))
+    return mismatches
+
+
+set_backends()
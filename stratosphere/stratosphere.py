@@ -1,44 +1,70 @@
 import colorama
-import difflib
-import importlib
-import inspect
+import json
 import logging
-import os
 import pprint
 import sys
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from googleapiclient import errors
 
 try:
-    from stratosphere.resources import Template
-    from stratosphere.utils import get_google_auth
+    from stratosphere import emulator
+    from stratosphere.cache import DiskCache
+    from stratosphere.diff import diff_configs
+    from stratosphere.operations import Backoff, OperationPoller, log_progress, resource_state
+    from stratosphere.profiling import profiler
+    from stratosphere.resources import TRACE
+    from stratosphere.scheduler import DependencyGraph, DeploymentScheduler
+    from stratosphere.templates import discover_templates, import_template_module, render_templates, template_classes
+    from stratosphere.utils import execute, get_client
 except ImportError:
     # Python2
-    from resources import Template
-    from utils import get_google_auth
+    import emulator
+    from cache import DiskCache
+    from diff import diff_configs
+    from operations import Backoff, OperationPoller, log_progress, resource_state
+    from profiling import profiler
+    from resources import TRACE
+    from scheduler import DependencyGraph, DeploymentScheduler
+    from templates import discover_templates, import_template_module, render_templates, template_classes
+    from utils import execute, get_client
 
 logger = logging.getLogger(__name__)
-dm = get_google_auth('deploymentmanager', 'v2')
 colorama.init()
 
+# Last fetched manifest of every deployment, keyed by (project, deployment name). An entry is
+# only used while the deployment's fingerprint is unchanged, so it never needs to expire.
+manifest_cache = DiskCache('manifests')
+
+# Deployment label holding Template.config_hash() of the last applied config. Label values
+# are limited to 63 lowercase characters, a SHA-1 hex digest is 40.
+CONFIG_HASH_LABEL = 'stratosphere-config-hash'
+
 sys.tracebacklimit = 5
 
-def color_diff(diff):
-    for line in diff:
-        if line.startswith('+'):
-            yield colorama.Fore.GREEN + line + colorama.Fore.RESET
-        elif line.startswith('-'):
-            yield colorama.Fore.RED + line + colorama.Fore.RESET
-        elif line.startswith('^'):
-            yield colorama.Fore.BLUE + line + colorama.Fore.RESET
-        else:
-            yield line
+DIFF_COLORS = {
+    'added': colorama.Fore.GREEN,
+    'removed': colorama.Fore.RED,
+    'changed': colorama.Fore.BLUE,
+    'hunk': colorama.Fore.BLUE,
+}
+
+def color_diff(entries):
+    """Colors (kind, line) entries as yielded by ConfigDiff.entries(), context lines stay as they are."""
+    for kind, line in entries:
+        color = DIFF_COLORS.get(kind)
+        yield color + line + colorama.Fore.RESET if color else line
+
+def get_dm():
+    """The Deployment Manager client, created on first use."""
+    return get_client('deploymentmanager', 'v2')
 
 def get_deployment(project, deployment):
     try:
-        result = dm.deployments().get(project=project, deployment=deployment).execute()
+        result = execute(get_dm().deployments().get(project=project, deployment=deployment))
         return result
     except errors.HttpError as e:
         if e.resp['status'] == '404':
@@ -54,42 +80,93 @@ def get_manifest(project, deployment):
         manifest = deployment['manifest'].split('/')[-1]
     except KeyError as e:
         manifest = deployment['update']['manifest'].split('/')[-1]
+    cached = manifest_cache.get(project, deployment['name'])
+    if cached and cached.get('fingerprint') == deployment.get('fingerprint') and cached.get('manifest') == manifest:
+        logger.debug('Using cached manifest {} of {}'.format(manifest, deployment['name']))
+        return cached['result']
     try:
-        result = dm.manifests().get(project=project, deployment=deployment['name'], manifest=manifest).execute()
-        return result
+        result = execute(get_dm().manifests().get(project=project, deployment=deployment['name'], manifest=manifest))
     except errors.HttpError as e:
         raise e
+    # Only the config is used, layout and expandedConfig can be a lot bigger
+    manifest_cache.set({
+        'fingerprint': deployment.get('fingerprint'),
+        'manifest': manifest,
+        'result': {'name': result.get('name'), 'config': result.get('config')},
+    }, project, deployment['name'])
+    return result
+
+def get_resource_states(project, operation):
+    """[(resource name, state)] of the deployment operation works on, empty once it was deleted."""
+    deployment = operation.get('targetLink', '').split('/')[-1]
+    resources = get_dm().resources()
+    request = resources.list(project=project, deployment=deployment)
+    states = []
+    while request is not None:
+        try:
+            result = execute(request)
+        except errors.HttpError as e:
+            if e.resp['status'] == '404':
+                return []
+            raise e
+        states.extend((r['name'], resource_state(r)) for r in result.get('resources', []))
+        request = resources.list_next(request, result)
+    return states
+
+def get_poller(project, max_interval=10.0):
+    """An OperationPoller for Deployment Manager operations in project, following their resources too."""
+    return OperationPoller(
+        lambda name: execute(get_dm().operations().get(project=project, operation=name)),
+        backoff=Backoff(ceiling=max_interval),
+        get_resources=lambda operation: get_resource_states(project, operation))
 
-def wait_for_completion(project, result):
+def wait_for_operation(project, result, callback=log_progress, max_interval=10.0):
+    """
+    Polls the operation in result with exponential backoff (capped at max_interval seconds)
+    until it is done, passing each OperationProgress to callback. Returns the final operation.
+    """
     print('Waiting for deployment {}...'.format(result['name']))
-    last_event = result
-    while not last_event['status'] in ['DONE', ]:
-        time.sleep(1)
-        last_event = dm.operations().get(project=project, operation=last_event['name']).execute()
-        logger.info('Operation: {name}, TargetLink: {targetLink}, Progress: {progress}, Status: {status}'
-                    .format(**last_event))
+    return get_poller(project, max_interval).wait([result], callback=callback)[result['name']]
+
+def check_completion(last_event):
     if len(last_event.get('error', [])):
         logging.error('*** Stack apply failed! ***')
-        logging.fatal(pprint.pprint(last_event))
+        logging.fatal(pprint.pformat(last_event))
         sys.exit(1)
     else:
         print('Stack action complete.')
 
-def confirm_action():
+def wait_for_completion(project, result, callback=log_progress, max_interval=10.0):
+    check_completion(wait_for_operation(project, result, callback=callback, max_interval=max_interval))
+
+def confirm_action(auto_approve=False, countdown=5):
+    """
+    Asks for confirmation on stdin, then counts down for countdown seconds so there's still a
+    chance to hit Ctrl-C. With auto_approve, the question is skipped.
+    """
     # input returns the empty string for "enter"
     yes = ('yes', 'y', 'ye', '')
     no = ('no', 'n')
 
-    sys.stdout.write("\nContinue? (yes/no) ")
-    choice = input().lower().strip()
+    if auto_approve:
+        sys.stdout.write("\nAuto-approved.\n")
+        choice = 'yes'
+    else:
+        sys.stdout.write("\nContinue? (yes/no) ")
+        try:
+            choice = input().lower().strip()
+        except EOFError:
+            sys.stdout.write("\nNo input available. Use --yes to continue without confirmation.\n")
+            return False
     if choice in yes:
-        sys.stdout.write('Running in ')
-        sys.stdout.flush()
-        for i in range(5, 0, -1):
-            sys.stdout.write('{}...'.format(i))
+        if countdown > 0:
+            sys.stdout.write('Running in ')
             sys.stdout.flush()
-            time.sleep(1)
-        sys.stdout.write("\n")
+            for i in range(countdown, 0, -1):
+                sys.stdout.write('{}...'.format(i))
+                sys.stdout.flush()
+                time.sleep(1)
+            sys.stdout.write("\n")
         return True
     elif choice in no:
         sys.stdout.write("Cancelled.\n")
@@ -97,59 +174,297 @@ def confirm_action():
         sys.stdout.write("Please respond with 'yes' or 'no'")
     return False
 
-def apply_deployment(project, template):
+class ApplyReport(object):
+    """
+    Machine-readable record of an apply: the planned action and the outcome of every
+    deployment. Statuses are planned, unchanged, cancelled, done, failed and skipped.
+    """
+    def __init__(self, project, action):
+        self.project = project
+        self.action = action
+        self.deployments = OrderedDict()
+
+    def add_plan(self, plan):
+        self.deployments[plan.name] = {
+            'name': plan.name,
+            'action': plan.action or 'none',
+            'diff': plan.diff.asObject(),
+            'status': 'planned' if plan.action else 'unchanged',
+        }
+
+    def set_status(self, name, status, operation=None):
+        entry = self.deployments.setdefault(name, {'name': name})
+        entry['status'] = status
+        if operation is not None:
+            entry['operation'] = operation.get('name')
+            if operation.get('error'):
+                entry['status'] = 'failed'
+                entry['error'] = operation['error']
+
+    def cancel(self):
+        for entry in self.deployments.values():
+            if entry.get('status') == 'planned':
+                entry['status'] = 'cancelled'
+
+    def asObject(self):
+        return {
+            'project': self.project,
+            'action': self.action,
+            'deployments': list(self.deployments.values()),
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.asObject(), f, indent=2, sort_keys=True, default=str)
+            f.write('\n')
+
+class DeploymentPlan(object):
+    """
+    What applying a template would do: insert a new deployment, update the existing one, or
+    nothing if its manifest already matches the template. With delete, the plan is to delete
+    the deployment, or nothing if it doesn't exist. A deployment whose last operation failed
+    is updated even without a diff, its manifest is the config that failed.
+    """
+    def __init__(self, template, body, deployment, diff, delete=False):
+        self.template = template
+        self.body = body
+        self.deployment = deployment
+        self.diff = diff
+        self.delete = delete
+        self.failed = deployment is not None and has_failed(deployment)
+
+    @property
+    def name(self):
+        return self.template.name
+
+    @property
+    def action(self):
+        if self.delete:
+            return 'delete' if self.deployment is not None else None
+        if self.deployment is None:
+            return 'insert'
+        return 'update' if self.diff or self.failed else None
+
+def get_label(deployment, key):
+    for label in deployment.get('labels') or []:
+        if label.get('key') == key:
+            return label.get('value')
+    return None
+
+def is_settled(deployment):
+    """True if the last operation on deployment finished without errors and no update is pending."""
+    operation = deployment.get('operation') or {}
+    return 'update' not in deployment and operation.get('status', 'DONE') == 'DONE' and not operation.get('error')
+
+def has_failed(deployment):
+    """True if the last operation on deployment finished with errors."""
+    operation = deployment.get('operation') or {}
+    return operation.get('status') == 'DONE' and bool(operation.get('error'))
+
+def plan_deployment(project, template, full_diff=False):
+    """
+    Works out what applying template would do. When the existing deployment carries the same
+    config hash label, the manifest isn't fetched at all. full_diff always compares against
+    the manifest, e.g. to catch changes made outside of stratosphere.
+    """
+    config_hash = template.config_hash()
     body = {
         'name': template.name,
         'description': 'project: {}, name: {}'.format(project, template.name),
+        'labels': [{'key': CONFIG_HASH_LABEL, 'value': config_hash}],
         'target': {
             'config': {
                 'content': str(template)
             }
         }
     }
-    result = None
-    try:
-        deployment = get_deployment(project, template.name)
-        if deployment:
-            logging.info('Deployment already exists. Getting changes for {}...'.format(template.name))
-            body['fingerprint'] = deployment.get('fingerprint')
-            changed = False
-            existing_template = get_manifest(project, deployment)['config']['content']
-            for diff in color_diff(difflib.unified_diff(existing_template.splitlines(),
-                                                        str(template).splitlines(),
-                                                        fromfile='Existing template', tofile='Proposed template')):
-                changed = True
-                print(diff)
-            if changed and confirm_action():
-                result = dm.deployments().update(project=project, deployment=template.name, body=body).execute()
-            else:
-                logging.info('No changes in the template.')
-                sys.exit(0)
+    deployment = get_deployment(project, template.name)
+    if not deployment:
+        return DeploymentPlan(template, body, None, diff_configs(None, template.asObject()))
+    # Keep labels set by anyone else, updates replace the whole list
+    body['labels'] = [label for label in deployment.get('labels') or []
+                      if label.get('key') != CONFIG_HASH_LABEL] + body['labels']
+    body['fingerprint'] = deployment.get('fingerprint')
+    if not full_diff and is_settled(deployment) and get_label(deployment, CONFIG_HASH_LABEL) == config_hash:
+        logger.info('{} is unchanged (config hash {})'.format(template.name, config_hash))
+        return DeploymentPlan(template, body, deployment, diff_configs(None, None))
+    logging.info('Deployment already exists. Getting changes for {}...'.format(template.name))
+    existing_template = get_manifest(project, deployment)['config']['content']
+    return DeploymentPlan(template, body, deployment, diff_configs(existing_template, template.asObject()))
+
+def plan_deletion(project, template):
+    """Plans deleting the deployment of template, the diff lists the resources that go away with it."""
+    deployment = get_deployment(project, template.name)
+    if not deployment:
+        return DeploymentPlan(template, None, None, diff_configs(None, None), delete=True)
+    existing_template = get_manifest(project, deployment)['config']['content']
+    return DeploymentPlan(template, None, deployment, diff_configs(existing_template, None), delete=True)
+
+def print_plan(plan):
+    if plan.action == 'insert':
+        logging.info('Generated template:\n%s\n', plan.template)
+        logging.info('Launching a new deployment: {}'.format(plan.name))
+    if plan.failed and not plan.delete:
+        logging.info('The last operation on {} failed, applying it again'.format(plan.name))
+    if plan.diff:
+        print('{}: {}'.format(plan.name, plan.diff.summary()))
+        for line in color_diff(plan.diff.entries()):
+            print(line)
+
+def submit_deployment(project, plan, delete_policy='DELETE'):
+    """
+    Starts the insert, update or delete described by plan and returns its operation.
+    delete_policy ABANDON deletes the deployment but keeps its resources.
+    """
+    if plan.action == 'insert':
+        return execute(get_dm().deployments().insert(project=project, body=plan.body))
+    elif plan.action == 'update':
+        return execute(get_dm().deployments().update(project=project, deployment=plan.name, body=plan.body))
+    elif plan.action == 'delete':
+        return execute(get_dm().deployments().delete(project=project, deployment=plan.name,
+                                                     deletePolicy=delete_policy))
+
+def plan_deployments(project, templates, max_workers=4, report=None, full_diff=False):
+    """Prints the changes applying templates would make, without changing anything."""
+    report = report or ApplyReport(project, 'plan')
+    graph = DependencyGraph.from_templates(templates)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        plans = dict((plan.name, plan) for plan in pool.map(lambda t: plan_deployment(project, t, full_diff), templates))
+    for name in graph.order():
+        report.add_plan(plans[name])
+        if plans[name].action:
+            print_plan(plans[name])
         else:
-            logging.info('Generated template:\n{}\n'.format(template))
-            logging.info('Launching a new deployment: {}'.format(template.name))
-            if confirm_action():
-                result = dm.deployments().insert(project=project, body=body).execute()
-    except errors.HttpError as e:
-        raise e
+            print('{}: no changes'.format(name))
+    return plans
+
+def apply_deployment(project, template, max_poll_interval=10.0, auto_approve=False, countdown=5, report=None,
+                     full_diff=False):
+    report = report or ApplyReport(project, 'apply')
+    plan = plan_deployment(project, template, full_diff)
+    report.add_plan(plan)
+    print_plan(plan)
+    result = None
+    if plan.action == 'update' and confirm_action(auto_approve, countdown):
+        result = submit_deployment(project, plan)
+    elif plan.action == 'update' or plan.action is None:
+        report.cancel()
+        logging.info('No changes in the template.')
+        sys.exit(0)
+    elif confirm_action(auto_approve, countdown):
+        result = submit_deployment(project, plan)
+    else:
+        report.cancel()
     if result:
-        return wait_for_completion(project, result)
+        last_event = wait_for_operation(project, result, max_interval=max_poll_interval)
+        report.set_status(plan.name, 'done', last_event)
+        return check_completion(last_event)
+
+def apply_deployments(project, templates, max_workers=4, max_poll_interval=10.0, auto_approve=False, countdown=5,
+                      report=None, full_diff=False):
+    """
+    Applies several templates at once. Deployments are ordered by their dependencies (see
+    DependencyGraph.from_templates), independent ones are submitted concurrently with at most
+    max_workers in flight, and all of their operations are polled together.
+    """
+    graph = DependencyGraph.from_templates(templates)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        plans = dict((plan.name, plan) for plan in pool.map(lambda t: plan_deployment(project, t, full_diff), templates))
+
+    report = report or ApplyReport(project, 'apply')
+    order = graph.order()
+    for name in order:
+        report.add_plan(plans[name])
+        print_plan(plans[name])
+    changed = [name for name in order if plans[name].action]
+    if not changed:
+        logging.info('No changes in the templates.')
+        sys.exit(0)
+    logging.info('Deployments to apply, in order: {}'.format(', '.join(changed)))
+    if not confirm_action(auto_approve, countdown):
+        report.cancel()
+        sys.exit(0)
+
+    run_plans(project, graph, plans, max_workers=max_workers, max_poll_interval=max_poll_interval, report=report)
+
+def run_plans(project, graph, plans, max_workers=4, max_poll_interval=10.0, report=None, delete_policy='DELETE'):
+    """
+    Submits plans ({name: DeploymentPlan}) in the order of graph, independent ones concurrently,
+    and polls their operations together. Exits with 1 if a deployment failed.
+    """
+    report = report or ApplyReport(project, 'apply')
+    scheduler = DeploymentScheduler(
+        graph,
+        submit=lambda name: submit_deployment(project, plans[name], delete_policy),
+        poller=get_poller(project, max_poll_interval),
+        max_workers=max_workers,
+        callback=log_progress)
+    for name, operation in scheduler.run().items():
+        report.set_status(name, 'done' if plans[name].action else 'unchanged', operation)
+    for name, failure in scheduler.failed.items():
+        report.set_status(name, 'failed', failure if isinstance(failure, dict) else {'error': str(failure)})
+    for name in scheduler.skipped:
+        report.set_status(name, 'skipped')
+    if scheduler.failed or scheduler.skipped:
+        logging.error('*** Stack {} failed! ***'.format(report.action))
+        for name, failure in scheduler.failed.items():
+            logging.error('{}: {}'.format(name, pprint.pformat(failure)))
+        if scheduler.skipped:
+            logging.error('Skipped: {}'.format(', '.join(scheduler.skipped)))
+        sys.exit(1)
+    print('Stack action complete.')
+
+def delete_deployments(project, templates, max_workers=4, max_poll_interval=10.0, auto_approve=False, countdown=5,
+                       report=None, delete_policy='DELETE'):
+    """
+    Deletes the deployments of templates in reverse dependency order: a deployment is only
+    deleted once everything that depends on it is gone. Independent deletions run concurrently
+    and their operations are polled together.
+    """
+    graph = DependencyGraph.from_templates(templates).reversed()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        plans = dict((plan.name, plan) for plan in pool.map(lambda t: plan_deletion(project, t), templates))
+
+    report = report or ApplyReport(project, 'delete')
+    order = graph.order()
+    for name in order:
+        report.add_plan(plans[name])
+        if plans[name].action:
+            print_plan(plans[name])
+        else:
+            print('{}: does not exist'.format(name))
+    deleted = [name for name in order if plans[name].action]
+    if not deleted:
+        logging.info('No deployments to delete.')
+        sys.exit(0)
+    logging.warning('Deployments to delete{}, in order: {}'.format(
+        ' (keeping their resources)' if delete_policy == 'ABANDON' else '', ', '.join(deleted)))
+    if not confirm_action(auto_approve, countdown):
+        report.cancel()
+        sys.exit(0)
+    run_plans(project, graph, plans, max_workers=max_workers, max_poll_interval=max_poll_interval, report=report,
+              delete_policy=delete_policy)
+    for name in deleted:
+        manifest_cache.delete(project, name)
 
 
 def load_template_module(module_path):
-    try:
-        if os.path.isfile(module_path):
-            path, filename = os.path.split(os.path.abspath(module_path))
-            module_name = filename.split('.')[0].lower()
-            sys.path.append(os.path.dirname(module_path))
-            module = importlib.import_module(module_name)
-            # Discover what the template class is from a template module.
-            template_class = [r[1] for r in inspect.getmembers(module, inspect.isclass)
-                              if r[0] != 'Template' and issubclass(r[1], Template)][0]
-            return template_class
-        raise TypeError
-    except TypeError:
+    """Returns the first template class of a template module, see templates.discover_templates for all of them."""
+    classes = template_classes(import_template_module(module_path))
+    if not classes:
         raise ImportError('Unable to import module: {}'.format(module_path))
+    return classes[0]
+
+
+def report_profile(json_path=None, trace_path=None):
+    """Prints the profiler's summary to stderr and writes the requested profile files."""
+    sys.stderr.write('\n{}\n'.format(profiler.summary()))
+    if json_path:
+        profiler.write_json(json_path)
+        logger.info('Wrote profile to %s', json_path)
+    if trace_path:
+        profiler.write_chrome_trace(trace_path)
+        logger.info('Wrote Chrome trace to %s', trace_path)
 
 
 @click.command()
@@ -157,15 +472,46 @@ def load_template_module(module_path):
 @click.option('--env', prompt='Deployment env',
               help='Env of deployment. Used for generating the deployment name: [env]-[template]')
 @click.option('--action', prompt="Deployment action", default='template',
-              type=click.Choice(['apply', 'template', 'delete']), help="What you want to do with this template")
+              type=click.Choice(['apply', 'plan', 'template', 'delete']),
+              help="What you want to do with this template. plan shows the changes apply would make, "
+                   "delete removes the template's deployment")
 @click.option('-v', '--verbose', required=False, default=0, count=True,
               help="Enable verbose logging, supply multiple for more logging")
 @click.option('--format', help="Set output format of template",
               type=click.Choice(['yaml', 'json']), default="yaml", required=False)
-@click.argument('template_path', type=click.Path(exists=True), required=False)
-def main(project, env, action, verbose, format, template_path):
+@click.option('--max-poll-interval', help="Maximum seconds between operation status checks",
+              type=float, default=10.0, required=False)
+@click.option('--workers', help="Maximum number of deployments applied concurrently, or of processes rendering "
+                                "templates with --output-dir",
+              type=int, default=4, required=False)
+@click.option('-y', '--yes', '--auto-approve', 'auto_approve', is_flag=True, default=False,
+              help="Apply without asking for confirmation")
+@click.option('--countdown', help="Seconds to wait after confirming, before applying",
+              type=click.IntRange(min=0), default=5, required=False)
+@click.option('--report', 'report_path', help="Write a JSON report of the planned and applied changes to this file",
+              type=click.Path(dir_okay=False, writable=True), required=False)
+@click.option('--full-diff', is_flag=True, default=False,
+              help="Always diff against the deployed manifest, even if the config hash label is unchanged")
+@click.option('--output-dir', help="With --action template, render every template to <output-dir>/<name>.<format>",
+              type=click.Path(file_okay=False, writable=True), required=False)
+@click.option('--render-processes', help="Render large templates in this many processes (output is unchanged)",
+              type=click.IntRange(min=1), required=False)
+@click.option('--profile', is_flag=True, default=False,
+              help="Time configure, validation, rendering and API calls and print a summary")
+@click.option('--profile-json', help="Write the --profile timers and counters to this JSON file",
+              type=click.Path(dir_okay=False, writable=True), required=False)
+@click.option('--profile-trace', help="Write a Chrome trace (chrome://tracing, Perfetto) of the run to this file",
+              type=click.Path(dir_okay=False, writable=True), required=False)
+@click.option('--delete-policy', help="With --action delete, ABANDON keeps the resources of deleted deployments",
+              type=click.Choice(['DELETE', 'ABANDON']), default='DELETE', required=False)
+@click.option('--dm-emulator', 'dm_emulator', envvar='STRATOSPHERE_DM_EMULATOR', required=False,
+              help="Use a local Deployment Manager emulator keeping its state in this file ('-' for memory only)")
+@click.argument('template_paths', nargs=-1)
+def main(project, env, action, verbose, format, max_poll_interval, workers, auto_approve, countdown, report_path,
+         full_diff, output_dir, render_processes, profile, profile_json, profile_trace, delete_policy,
+         dm_emulator, template_paths):
     if verbose >= 2:
-        level = 5
+        level = TRACE
     elif verbose == 1:
         level = logging.DEBUG
     else:
@@ -173,30 +519,81 @@ def main(project, env, action, verbose, format, template_path):
         logging.getLogger('oauth2client').setLevel(logging.ERROR)
         level = logging.INFO
 
-    logging.addLevelName(5, "TRACE")
+    logging.addLevelName(TRACE, "TRACE")
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(name)s:%(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S', level=level)
 
     logger.debug('Debug log enabled')
     logger.info("Log level: {}".format(level))
 
-    if action in ['apply', 'template']:
-        if template_path is None:
+    if dm_emulator:
+        emulator.install(emulator.DeploymentManagerEmulator.from_environment(
+            None if dm_emulator == '-' else dm_emulator))
+
+    if profile or profile_json or profile_trace:
+        profiler.enable()
+        # Runs however main ends, including the sys.exit() calls below
+        click.get_current_context().call_on_close(lambda: report_profile(profile_json, profile_trace))
+
+    if action in ['apply', 'plan', 'template', 'delete']:
+        if not template_paths:
             logging.error('A path to a template file is required for {}'.format(action))
             sys.exit(1)
-        template_class = load_template_module(template_path)
-        template = template_class(project, env)
+        discovered = discover_templates(template_paths)
+        if action == 'template' and output_dir:
+            try:
+                paths = render_templates(discovered, project, env, output_dir, format=format, max_workers=workers,
+                                         render_processes=render_processes)
+            except RuntimeError as e:
+                logging.error(e)
+                sys.exit(1)
+            for path in paths:
+                logger.info('Wrote %s', path)
+            sys.exit(0)
+        templates = [template_class(project, env) for _, template_class in discovered]
 
-        if format == "json":
-            template.formatter = template.asJSON
+        for template in templates:
+            template.render_processes = render_processes
+            if format == "json":
+                template.formatter = template.asJSON
 
-        if action == 'apply':
-            template.__repr__()
-            apply_deployment(project, template)
+        if action == 'plan':
+            report = ApplyReport(project, action)
+            try:
+                plan_deployments(project, templates, max_workers=workers, report=report, full_diff=full_diff)
+            finally:
+                if report_path:
+                    report.write(report_path)
+        elif action == 'apply':
+            report = ApplyReport(project, action)
+            try:
+                if len(templates) > 1:
+                    apply_deployments(project, templates, max_workers=workers, max_poll_interval=max_poll_interval,
+                                      auto_approve=auto_approve, countdown=countdown, report=report,
+                                      full_diff=full_diff)
+                else:
+                    apply_deployment(project, templates[0], max_poll_interval=max_poll_interval,
+                                     auto_approve=auto_approve, countdown=countdown, report=report,
+                                     full_diff=full_diff)
+            finally:
+                if report_path:
+                    report.write(report_path)
+        elif action == 'delete':
+            report = ApplyReport(project, action)
+            try:
+                delete_deployments(project, templates, max_workers=workers, max_poll_interval=max_poll_interval,
+                                   auto_approve=auto_approve, countdown=countdown, report=report,
+                                   delete_policy=delete_policy)
+            finally:
+                if report_path:
+                    report.write(report_path)
         elif action == 'template':
-            t = template.__repr__()
-            logger.info('Template successfully rendered, printing to stdout...')
-            print(t)
+            if len(templates) > 1:
+                logging.error('--action template renders a single template to stdout, use --output-dir for more')
+                sys.exit(1)
+            logger.info('Rendering template to stdout...')
+            templates[0].render_to(sys.stdout, format=format)
+            print()
             sys.exit(0)
 
 
@@ -0,0 +1,270 @@
+import glob
+import inspect
+import logging
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from stratosphere.resources import Template
+except ImportError:
+    # Python2
+    from resources import Template
+
+logger = logging.getLogger(__name__)
+
+FORMAT_EXTENSIONS = {'yaml': 'yaml', 'json': 'json'}
+
+
+def expand_paths(paths):
+    """
+    Turns template paths into a sorted list of module files. Each path can be a file, a
+    directory (every *.py file directly in it) or a glob pattern like templates/*/*.py.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, '*.py'))
+        elif os.path.isfile(path):
+            matches = [path]
+        else:
+            matches = [m for m in glob.glob(path) if os.path.isfile(m)]
+        if not matches:
+            raise ImportError('No template modules found at: {}'.format(path))
+        files.extend(sorted(m for m in matches if not os.path.basename(m).startswith('__')))
+    seen = set()
+    unique = []
+    for f in files:
+        key = os.path.abspath(f)
+        if key not in seen:
+            seen.add(key)
+            unique.append(f)
+    return unique
+
+
+def module_name(module_path):
+    """
+    A module name unique to the file, so that modules sharing a file name in different
+    directories (templates/a/net.py, templates/b/net.py) don't replace each other.
+    """
+    return 'stratosphere_template_' + re.sub(r'\W', '_', os.path.splitext(os.path.abspath(module_path))[0])
+
+
+# Directories template modules were imported from, see import_template_module
+_template_directories = set()
+# Where the standard library, installed packages and stratosphere itself live, _check_neighbours
+# doesn't look into their modules
+_LIBRARY_PREFIXES = tuple(set(os.path.join(os.path.abspath(p), '') for p in (
+    sys.prefix, sys.exec_prefix, getattr(sys, 'base_prefix', sys.prefix), os.path.dirname(os.path.abspath(__file__)))))
+
+
+def _module_directory(module):
+    """The directory module was imported from (the parent of a package's directory), or None."""
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    if os.path.splitext(os.path.basename(path))[0] == '__init__':
+        path = os.path.dirname(path)
+    return os.path.dirname(path)
+
+
+def neighbour_names(directory):
+    """Names the modules and packages in directory can be imported by from its neighbours."""
+    names = set()
+    for entry in os.listdir(directory):
+        path = os.path.join(directory, entry)
+        if entry.endswith('.py') and os.path.isfile(path):
+            names.add(entry[:-3])
+        elif os.path.isfile(os.path.join(path, '__init__.py')):
+            names.add(entry)
+    return names
+
+
+def _use_directory(directory):
+    """
+    Puts directory first on sys.path and drops the modules cached from another template
+    directory under a name one of its neighbours has, so that e.g. templates/a/net.py and
+    templates/b/net.py each get their own constants module by `import constants`.
+    """
+    if directory in sys.path:
+        sys.path.remove(directory)
+    sys.path.insert(0, directory)
+    names = neighbour_names(directory)
+    for name, module in list(sys.modules.items()):
+        if module is None or name.split('.')[0] not in names:
+            continue
+        module_directory = _module_directory(sys.modules.get(name.split('.')[0]) or module)
+        if module_directory != directory and module_directory in _template_directories:
+            del sys.modules[name]
+    _template_directories.add(directory)
+
+
+def _check_neighbours(module, directory):
+    """
+    Raises ImportError if module uses, directly or through shared helper modules, a module of
+    another directory with the same name as one of its own neighbours. That happens when a
+    shared helper imported e.g. constants for an earlier template. Rendering this one with the
+    wrong constants would otherwise go unnoticed.
+    """
+    names = neighbour_names(directory)
+    seen = set()
+    stack = [module]
+    while stack:
+        current = stack.pop()
+        for value in vars(current).values():
+            if not inspect.ismodule(value) or id(value) in seen:
+                continue
+            seen.add(id(value))
+            value_directory = _module_directory(sys.modules.get(value.__name__.split('.')[0]) or value)
+            if value_directory is None or (value_directory not in _template_directories and
+                                           os.path.join(value_directory, '').startswith(_LIBRARY_PREFIXES)):
+                continue
+            if value.__name__.split('.')[0] in names and value_directory != directory:
+                raise ImportError('{} uses {} from {} instead of the one in {}. Template directories '
+                                  'sharing a helper module name must not share other helpers importing '
+                                  'it'.format(module.__file__, value.__name__, value_directory, directory))
+            stack.append(value)
+
+
+def import_template_module(module_path):
+    """
+    Imports a template module from a file. Its directory is put first on sys.path so it can
+    import its neighbours, e.g. a shared constants module. Neighbours with the same name in
+    different template directories are kept apart, see _use_directory.
+    """
+    if not os.path.isfile(module_path):
+        raise ImportError('Unable to import module: {}'.format(module_path))
+    directory = os.path.dirname(os.path.abspath(module_path))
+    name = module_name(module_path)
+    if name in sys.modules:
+        return sys.modules[name]
+    _use_directory(directory)
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # Python2
+        import imp
+        module = imp.load_source(name, module_path)
+    else:
+        spec = spec_from_file_location(name, module_path)
+        module = module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    try:
+        _check_neighbours(module, directory)
+    except ImportError:
+        del sys.modules[name]
+        raise
+    return module
+
+
+def template_classes(module):
+    """
+    The deployable Template subclasses defined in a module (those with a TEMPLATE_TYPE). Modules
+    that don't define any of their own fall back to the ones they import.
+    """
+    candidates = [c for _, c in inspect.getmembers(module, inspect.isclass)
+                  if issubclass(c, Template) and c is not Template and c.TEMPLATE_TYPE is not None]
+    own = [c for c in candidates if c.__module__ == module.__name__]
+    return own or candidates
+
+
+def same_class(a, b):
+    """
+    Whether a and b are the same class, also when one was imported by its plain module name
+    from a neighbouring template and the other through import_template_module.
+    """
+    if a is b:
+        return True
+    try:
+        return a.__name__ == b.__name__ and os.path.abspath(inspect.getfile(a)) == os.path.abspath(inspect.getfile(b))
+    except TypeError:
+        return False
+
+
+def discover_templates(paths):
+    """
+    Returns [(module path, template class)] for every template in paths (files, directories or
+    globs), raising ValueError if two of them would get the same deployment name.
+    """
+    found = []
+    types = {}
+    for module_path in expand_paths(paths):
+        classes = template_classes(import_template_module(module_path))
+        if not classes:
+            logger.debug('No templates in %s', module_path)
+        for template_class in classes:
+            known = types.get(template_class.TEMPLATE_TYPE)
+            if known is None:
+                types[template_class.TEMPLATE_TYPE] = (module_path, template_class)
+                found.append((module_path, template_class))
+            elif not same_class(known[1], template_class):
+                raise ValueError('TEMPLATE_TYPE {} is used by both {}.{} and {}.{}'.format(
+                    template_class.TEMPLATE_TYPE, known[0], known[1].__name__, module_path, template_class.__name__))
+    return found
+
+
+def output_path(output_dir, template, format='yaml'):
+    return os.path.join(output_dir, '{}.{}'.format(template.name, FORMAT_EXTENSIONS[format]))
+
+
+def render_template_file(module_path, class_name, project, env, output_dir, format='yaml', render_processes=None):
+    """
+    Renders one template to <output_dir>/<deployment name>.<format> and returns the file's path.
+    Takes the module path rather than the class, so it also works in a freshly spawned process.
+    render_processes is set on the template, see Template.render_processes.
+    """
+    template = getattr(import_template_module(module_path), class_name)(project, env)
+    template.render_processes = render_processes
+    path = output_path(output_dir, template, format)
+    with open(path, 'w') as f:
+        try:
+            template.render_to(f, format=format)
+            f.write('\n')
+        except Exception:
+            # Don't leave a truncated file behind that looks like a rendered template
+            f.close()
+            os.remove(path)
+            raise
+    return path
+
+
+def render_templates(templates, project, env, output_dir, format='yaml', max_workers=None, render_processes=None):
+    """
+    Renders [(module path, template class)] (see discover_templates) to one file per template,
+    in parallel worker processes. Returns the written paths in the same order. A template that
+    fails doesn't stop the others, a RuntimeError naming all failed templates is raised at the end.
+    render_processes additionally shards the YAML of each template, see Template.render_processes.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    jobs = [(module_path, template_class.__name__, project, env, output_dir, format, render_processes)
+            for module_path, template_class in templates]
+    if len(jobs) < 2 or max_workers == 1:
+        results = [_call(render_template_file, job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = [pool.submit(render_template_file, *job) for job in jobs]
+            results = [_call(future.result, ()) for future in futures]
+
+    failed = []
+    for (module_path, class_name, _, _, _, _, _), (path, error) in zip(jobs, results):
+        if error is not None:
+            logger.error('Rendering %s from %s failed: %s', class_name, module_path, error)
+            failed.append(class_name)
+    if failed:
+        raise RuntimeError('Unable to render templates: {}'.format(', '.join(failed)))
+    return [path for path, _ in results]
+
+
+def _call(function, args):
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, e
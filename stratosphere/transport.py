@@ -0,0 +1,156 @@
+"""
+The HTTP layer every Google API request goes through: one keep-alive connection per thread
+(and timeout), and retries with exponential backoff on rate limiting (429, and 403 with a rate
+limit reason), server errors (5xx) and dropped connections.
+
+Defaults can be changed with STRATOSPHERE_HTTP_TIMEOUT (seconds per request, default 60) and
+STRATOSPHERE_HTTP_RETRIES (default 5).
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from stratosphere.operations import Backoff
+    from stratosphere.profiling import profiler
+except ImportError:
+    # Python2
+    from operations import Backoff
+    from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Google APIs report exhausted quotas as 403 with one of these reasons, other 403s are final
+RATE_LIMIT_REASONS = frozenset(['rateLimitExceeded', 'userRateLimitExceeded'])
+# A connection can drop after the server got the request, only these are safe to send again then
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE'])
+
+DEFAULT_TIMEOUT = float(os.environ.get('STRATOSPHERE_HTTP_TIMEOUT', 60))
+MAX_RETRIES = int(os.environ.get('STRATOSPHERE_HTTP_RETRIES', 5))
+
+
+def default_backoff():
+    return Backoff(initial=1.0, multiplier=2.0, ceiling=32.0, jitter=0.5)
+
+
+def error_reasons(content):
+    """The reasons of a Google API error response body, e.g. {'rateLimitExceeded'}."""
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        error = json.loads(content).get('error')
+    except (AttributeError, TypeError, ValueError):
+        return set()
+    if not isinstance(error, dict):
+        return set()
+    return set(e.get('reason') for e in error.get('errors') or [] if isinstance(e, dict))
+
+
+def is_retryable(status, content=None):
+    """Whether a response with status and error body content is worth sending again."""
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and bool(error_reasons(content) & RATE_LIMIT_REASONS)
+
+
+class Transport(object):
+    """
+    authorize (callable): Takes a new httplib2.Http and returns it authorized, e.g.
+                          credentials.authorize. None leaves connections unauthenticated.
+    timeout (float): Default socket timeout of every request, in seconds
+    max_retries (int): Retries after the first attempt, 0 disables retrying
+    backoff (callable): Returns a new Backoff for each request
+    sleep: Injectable for tests
+    """
+    def __init__(self, authorize=None, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES, backoff=default_backoff,
+                 sleep=time.sleep):
+        self.authorize = authorize
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sleep = sleep
+        # httplib2 connections aren't thread-safe, every thread gets its own, kept alive between requests
+        self._local = threading.local()
+
+    def connection(self, timeout=None):
+        """This thread's httplib2.Http for timeout (default: self.timeout)."""
+        timeout = self.timeout if timeout is None else timeout
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        http = connections.get(timeout)
+        if http is None:
+            import httplib2
+            http = httplib2.Http(timeout=timeout)
+            if self.authorize is not None:
+                http = self.authorize(http)
+            connections[timeout] = http
+        return http
+
+    def reset(self):
+        """Drops this thread's connections, e.g. after one of them broke."""
+        self._local.connections = {}
+
+    def execute(self, request, http=None, timeout=None):
+        """
+        Executes a googleapiclient request with retries, over http if given and otherwise over
+        this thread's connection for timeout.
+        """
+        from googleapiclient.errors import HttpError
+        import httplib2
+        backoff = self.backoff()
+        attempt = 0
+        while True:
+            try:
+                return request.execute(http=http or self.connection(timeout))
+            except HttpError as e:
+                status = int(e.resp.status)
+                if not is_retryable(status, e.content) or attempt >= self.max_retries:
+                    raise
+                reason = 'HTTP {}'.format(status)
+            except (OSError, httplib2.HttpLib2Error) as e:
+                if getattr(request, 'method', 'GET') not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    raise
+                reason = '{}: {}'.format(type(e).__name__, e)
+                if http is None:
+                    self.reset()
+            attempt += 1
+            self._wait(backoff, attempt, getattr(request, 'method', ''), getattr(request, 'uri', request), reason)
+
+    def request(self, uri, method='GET', timeout=None):
+        """
+        Sends a plain HTTP request, e.g. for a discovery document, over this thread's connection
+        for timeout and with the same retries as execute(). Returns the response body, raises
+        IOError if the response isn't a success or the connection keeps failing.
+        """
+        import httplib2
+        backoff = self.backoff()
+        attempt = 0
+        while True:
+            try:
+                response, content = self.connection(timeout).request(uri, method)
+            except (OSError, httplib2.HttpLib2Error) as e:
+                if method not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    raise IOError('{} {} failed: {}: {}'.format(method, uri, type(e).__name__, e))
+                reason = '{}: {}'.format(type(e).__name__, e)
+                self.reset()
+            else:
+                status = int(response.status)
+                if 200 <= status < 300:
+                    return content
+                if not is_retryable(status, content) or attempt >= self.max_retries:
+                    raise IOError('{} {} returned HTTP {}'.format(method, uri, status))
+                reason = 'HTTP {}'.format(status)
+            attempt += 1
+            self._wait(backoff, attempt, method, uri, reason)
+
+    def _wait(self, backoff, attempt, method, uri, reason):
+        delay = backoff.next()
+        if profiler.enabled:
+            profiler.count('api.retries')
+        logger.warning('%s %s failed (%s), retry %d/%d in %.1fs', method, uri, reason, attempt, self.max_retries,
+                       delay)
+        self.sleep(delay)
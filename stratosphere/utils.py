@@ -1,37 +1,236 @@
+import logging
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+try:
+    from stratosphere.cache import DiskCache
+    from stratosphere.profiling import profiler
+    from stratosphere.serialization import load_json
+    from stratosphere.transport import Transport
+except ImportError:
+    # Python2
+    from cache import DiskCache
+    from profiling import profiler
+    from serialization import load_json
+    from transport import Transport
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{service}/{version}/rest'
+# Discovery documents only change when Google updates an API, refetch them once a day by default
+DISCOVERY_TTL = int(os.environ.get('STRATOSPHERE_DISCOVERY_TTL', 24 * 60 * 60))
+discovery_cache = DiskCache('discovery', ttl=DISCOVERY_TTL)
+
+# Google puts public images in different projects.
+PUBLIC_IMAGE_PROJECTS = ['centos-cloud', 'coreos-cloud', 'debian-cloud', 'ubuntu-os-cloud']
+# Resolved images are only cached on disk if this is set (in seconds), since new images get published
+IMAGE_CACHE_TTL = int(os.environ.get('STRATOSPHERE_IMAGE_CACHE_TTL', 0))
+image_cache = DiskCache('images', ttl=IMAGE_CACHE_TTL)
+
+# Process-wide API clients keyed by (service, version), see get_client()
+_clients = {}
+_clients_lock = threading.Lock()
+_credentials = []
+# Authorized keep-alive connections and retries for every API request, see execute()
+transport = Transport(authorize=lambda http: get_credentials().authorize(http))
+# Discovery documents are public, fetching them needs no credentials
+discovery_transport = Transport(timeout=30)
+# Thread-safe connections of clients given to register_client(), execute() uses them as is
+_shared_http = []
+# Per-process image lookups, see get_latest_image()
+_project_images = {}
+_resolved_images = {}
+
+
+def get_credentials():
+    """Discovers the application default credentials once per process."""
+    if not _credentials:
+        from oauth2client.client import GoogleCredentials
+        with _clients_lock:
+            if not _credentials:
+                _credentials.append(GoogleCredentials.get_application_default())
+    return _credentials[0]
+
+
+def fetch_discovery_document(service, version):
+    url = DISCOVERY_URL.format(service=service, version=version)
+    logger.debug('Fetching discovery document %s', url)
+    with profiler.timer('api.discovery.{}.{}'.format(service, version)):
+        return load_json(discovery_transport.request(url).decode('utf-8'))
+
+
+def seed_discovery_document(service, version, document):
+    """
+    Pre-seeds the on-disk discovery cache, e.g. with a document bundled for offline tests.
+
+    document (dict|str): A parsed discovery document, its JSON text, or a path to a JSON file
+    """
+    if isinstance(document, str):
+        if os.path.isfile(document):
+            with open(document) as f:
+                document = f.read()
+        document = load_json(document)
+    discovery_cache.set(document, service, version)
+
+
+def get_static_discovery_document(service, version):
+    """The discovery document bundled with googleapiclient (2.x and later), if there is one."""
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        return None
+    document = get_static_doc(service, version)
+    return load_json(document) if document else None
+
+
+def get_discovery_document(service, version):
+    """
+    Returns the API discovery document for service/version: a fresh copy from the on-disk
+    cache, else the document bundled with googleapiclient, which needs no request at all.
+    Only without either is it fetched over HTTP and cached for DISCOVERY_TTL. If that fetch
+    fails, an expired cached copy is used and cached again, so runs without network access
+    don't retry the fetch every time.
+    """
+    document = discovery_cache.get(service, version)
+    if document is not None:
+        return document
+    document = get_static_discovery_document(service, version)
+    if document is not None:
+        return document
+    try:
+        document = fetch_discovery_document(service, version)
+    except (IOError, OSError, ValueError) as e:
+        document = discovery_cache.get(service, version, allow_stale=True)
+        if document is None:
+            raise
+        logger.warning('Unable to refresh discovery document for %s/%s, using the cached copy: %s',
+                       service, version, e)
+    discovery_cache.set(document, service, version)
+    return document
 
 
 def get_google_auth(service, version='v2'):
-    credentials = GoogleCredentials.get_application_default()
-    service_conn = discovery.build(service, version, credentials=credentials)
+    # Imported here so that rendering templates never needs googleapiclient or credentials
+    from googleapiclient import discovery
+    # Built on the transport's connection rather than one of its own, execute() picks the
+    # calling thread's connection for each request anyway
+    service_conn = discovery.build_from_document(get_discovery_document(service, version), http=get_http())
     return service_conn
 
 
-def get_latest_image(project, name):
+def get_client(service, version='v2'):
+    """
+    Returns the process-wide client for a Google API service/version, building it with
+    get_google_auth() on first use.
+    """
+    key = (service, version)
+    client = _clients.get(key)
+    if client is None:
+        client = get_google_auth(service, version)
+        with _clients_lock:
+            client = _clients.setdefault(key, client)
+    return client
+
+
+def register_client(service, version, client, shared_http=None):
+    """
+    Makes get_client() return client for service/version, e.g. one backed by an emulator.
+    Requests of the client go through shared_http instead of this thread's authorized
+    connection if it is given, it must be safe to use from several threads.
+    """
+    with _clients_lock:
+        _clients[(service, version)] = client
+        if shared_http is not None and not any(shared_http is h for h in _shared_http):
+            _shared_http.append(shared_http)
+
+
+def get_http(timeout=None):
+    """Returns this thread's authorized httplib2.Http."""
+    return transport.connection(timeout)
+
+
+def execute(request, timeout=None):
+    """
+    Executes a googleapiclient request through the shared transport: on the calling thread's
+    own keep-alive connection, so requests built from the shared clients can be run from several
+    threads at once, and retried on 429/5xx responses and dropped connections.
+
+    timeout (float): Socket timeout for this request, transport.DEFAULT_TIMEOUT by default
+    """
+    http = getattr(request, 'http', None)
+    if not any(http is h for h in _shared_http):
+        http = None
+    if profiler.enabled:
+        with profiler.timer('api.{}'.format(getattr(request, 'methodId', None) or type(request).__name__),
+                            uri=getattr(request, 'uri', None)):
+            return transport.execute(request, http=http, timeout=timeout)
+    return transport.execute(request, http=http, timeout=timeout)
+
+
+def list_images(project):
+    """Lists every image of a project, following pagination. Cached per process."""
+    images = _project_images.get(project)
+    if images is None:
+        images = []
+        compute = get_client('compute', 'v1')
+        request = compute.images().list(project=project)
+        while request is not None:
+            result = execute(request)
+            images.extend(result.get('items', []))
+            request = compute.images().list_next(previous_request=request, previous_response=result)
+        _project_images[project] = images
+    return images
+
+
+def _newest_matching_image(project, name):
+    matches = [image for image in list_images(project) if name in image['name']]
+    return max(matches, key=lambda image: image['creationTimestamp']) if matches else None
+
+
+def _image_from_family(project, family):
+    from googleapiclient import errors
+    compute = get_client('compute', 'v1')
+    try:
+        return execute(compute.images().getFromFamily(project=project, family=family))
+    except errors.HttpError as e:
+        if e.resp.status == 404:
+            return None
+        raise
+
+
+def get_latest_image(project, name, family=False):
     '''
     This attempts to return the latest image based on an search string.
+
+    project (str): Your project, searched in addition to the public image projects
+    name (str): A substring of the image name, or an image family name if family is True
+    family (bool): Resolve name as an image family (e.g. 'debian-8') instead of a substring
+
+    The projects are searched concurrently and results are cached for the rest of the process,
+    and on disk for STRATOSPHERE_IMAGE_CACHE_TTL seconds if that is set.
     '''
-    g = get_google_auth('compute', 'v1')
-
-    # Google puts public images in different projects.
-    newest_image = None
-    for _project in ['centos-cloud', 'coreos-cloud', 'debian-cloud', 'ubuntu-os-cloud', project]:
-        result = g.images().list(project=_project).execute()
-        for image in result.get('items', []):
-            if image['name'].find(name) != -1:
-                if not newest_image:
-                    newest_image = image
-                else:
-                    if image['creationTimestamp'] > newest_image['creationTimestamp']:
-                        newest_image = image
-
-    if not newest_image:
+    key = (project, name, 'family' if family else 'name')
+    self_link = _resolved_images.get(key)
+    if self_link is None and IMAGE_CACHE_TTL:
+        self_link = image_cache.get(*key)
+    if self_link is not None:
+        _resolved_images[key] = self_link
+        return self_link
+
+    lookup = _image_from_family if family else _newest_matching_image
+    projects = PUBLIC_IMAGE_PROJECTS + [project]
+    with ThreadPoolExecutor(max_workers=len(projects)) as pool:
+        candidates = [image for image in pool.map(lambda p: lookup(p, name), projects) if image]
+
+    if not candidates:
         raise KeyError("No images found for {}/{}".format(project, name))
 
-    return newest_image['selfLink']
+    self_link = max(candidates, key=lambda image: image['creationTimestamp'])['selfLink']
+    _resolved_images[key] = self_link
+    if IMAGE_CACHE_TTL:
+        image_cache.set(self_link, *key)
+    return self_link
 
 
 def load_startup_script(path, replacements=None):
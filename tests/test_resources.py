@@ -0,0 +1,84 @@
+import copy
+import pickle
+
+from stratosphere.compute import Firewall, Network
+from stratosphere.compute_properties import FirewallAllowedPorts
+from stratosphere.resources import Template
+
+
+def firewall():
+    return Firewall(
+        name='dev-ssh',
+        network='$(ref.dev-network.selfLink)',
+        allowed=[FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.TCP, ports=['22'])],
+        sourceRanges=['10.0.0.0/8'])
+
+
+def ports(resource):
+    return resource.asObject()['properties']['allowed'][0]['ports']
+
+
+class Networks(Template):
+    TEMPLATE_TYPE = 'networks'
+
+    def configure(self):
+        self.add_resource(Network(name='dev-network', autoCreateSubnetworks=False))
+        self.add_resource(firewall())
+
+
+def test_nested_change_invalidates_parents():
+    f = firewall()
+    fingerprint = f.fingerprint()
+    assert ports(f) == ['22']
+    f.properties['allowed'][0]._set_property('ports', ['99'])
+    assert ports(f) == ['99']
+    assert f.fingerprint() != fingerprint
+
+
+def test_nested_change_invalidates_template():
+    template = Networks('project', 'dev')
+    template.ensure_configured()
+    config_hash = template.config_hash()
+    assert "- '22'" in template.asYAML()
+    template.resources[1].properties['allowed'][0]._set_property('ports', ['99'])
+    assert "- '99'" in template.asYAML()
+    assert template.config_hash() != config_hash
+
+
+def test_deepcopy_is_independent():
+    f = firewall()
+    fingerprint = f.fingerprint()
+    g = copy.deepcopy(f)
+    assert g == f
+    g.properties['allowed'][0]._set_property('ports', ['99'])
+    assert ports(g) == ['99']
+    assert ports(f) == ['22']
+    assert f.fingerprint() == fingerprint
+    assert g.fingerprint() != fingerprint
+
+
+def test_copied_template_is_independent():
+    template = Networks('project', 'dev')
+    template.ensure_configured()
+    rendered = template.asYAML()
+    copied = copy.deepcopy(template)
+    copied.resources[1].properties['allowed'][0]._set_property('ports', ['99'])
+    assert "- '99'" in copied.asYAML()
+    assert template.asYAML() == rendered
+
+
+def test_pickle_round_trip():
+    f = firewall()
+    f.asObject()
+    g = pickle.loads(pickle.dumps(f))
+    assert g == f
+    assert g.asObject() == f.asObject()
+    g.properties['allowed'][0]._set_property('ports', ['99'])
+    assert ports(g) == ['99']
+
+    template = Networks('project', 'dev')
+    template.ensure_configured()
+    loaded = pickle.loads(pickle.dumps(template))
+    assert loaded.asYAML() == template.asYAML()
+    loaded.resources[1].properties['allowed'][0]._set_property('ports', ['99'])
+    assert "- '99'" in loaded.asYAML()
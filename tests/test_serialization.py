@@ -0,0 +1,111 @@
+import io
+import json
+import os
+
+import pytest
+
+from stratosphere import serialization
+from stratosphere.compute import Firewall, Network
+from stratosphere.compute_properties import FirewallAllowedPorts
+from stratosphere.resources import Template
+from stratosphere.templates import import_template_module, template_classes
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_templates')
+# nfs-server.py looks up images through the Compute API, so it can't be rendered offline
+EXAMPLE_MODULES = ['networks.py', 'gke_cluster.py']
+
+STRINGS = [
+    'x' * 5000,
+    ' '.join(['word'] * 2000),
+    '#!/bin/bash\nset -e\n\n  indented\ttab\nlast line without newline',
+    'trailing newline\n',
+    '\n\nleading newlines',
+    'single \' and double " quotes',
+    '"quoted"',
+    "'quoted'",
+    ': colon, # hash, - dash, {braces}, [brackets], &anchor, *alias, !tag, %percent, @at, `tick`',
+    '- looks like a list item',
+    'yes', 'no', 'null', '~', '1e3', '0x1F', '010', '',
+    '  leading and trailing spaces  ',
+    'unicode éè ☃ \U0001f600',
+    'control \x07 and \u0085 characters',
+]
+
+
+def example_templates():
+    for filename in EXAMPLE_MODULES:
+        for template_class in template_classes(import_template_module(os.path.join(EXAMPLES, filename))):
+            yield pytest.param(template_class, id=template_class.TEMPLATE_TYPE)
+
+
+class StringsTemplate(Template):
+    TEMPLATE_TYPE = 'strings'
+
+    def configure(self):
+        network = Network(name='strings-network', autoCreateSubnetworks=False)
+        self.add_resource(network)
+        for i, description in enumerate(STRINGS):
+            self.add_resource(Firewall(
+                name='strings-firewall-{}'.format(i),
+                description=description,
+                network=network.Ref,
+                allowed=[FirewallAllowedPorts(IPProtocol=FirewallAllowedPorts.TCP, ports=['22'])],
+                sourceRanges=['10.0.0.0/8']))
+
+
+def configured(template_class):
+    template = template_class('my-project', 'dev')
+    template.ensure_configured()
+    return template
+
+
+def rendered_to(template_class, format):
+    # A fresh template, so render_to streams the resources rather than reusing asYAML()/asJSON()
+    stream = io.StringIO()
+    configured(template_class).render_to(stream, format=format)
+    return stream.getvalue()
+
+
+TEMPLATES = list(example_templates()) + [pytest.param(StringsTemplate, id='strings')]
+
+
+def test_strings_document_backends_agree():
+    document = {'resources': [{'name': 'r{}'.format(i), 'value': s} for i, s in enumerate(STRINGS)],
+                'nested': {'lines': STRINGS, 'empty': [], 'numbers': [0, -1, 1.5, 1e20, True, False, None]}}
+    assert serialization.verify_backends(document) == []
+
+
+@pytest.mark.parametrize('template_class', TEMPLATES)
+def test_template_backends_agree(template_class):
+    assert serialization.verify_backends(configured(template_class).asObject()) == []
+
+
+@pytest.mark.parametrize('yaml_backend', sorted(serialization.YAML_BACKENDS))
+@pytest.mark.parametrize('template_class', TEMPLATES)
+def test_yaml_render_to_matches_asYAML(template_class, yaml_backend):
+    previous = serialization.get_backends()['yaml']
+    serialization.set_backends(yaml_backend=yaml_backend)
+    try:
+        expected = configured(template_class).asYAML()
+        assert rendered_to(template_class, 'yaml') == expected
+        assert serialization.load_yaml(expected) == configured(template_class).asObject()
+    finally:
+        serialization.set_backends(yaml_backend=previous)
+
+
+@pytest.mark.parametrize('template_class', TEMPLATES)
+def test_json_render_to_matches_asJSON(template_class):
+    expected = configured(template_class).asJSON()
+    assert rendered_to(template_class, 'json') == expected
+    assert json.loads(expected) == configured(template_class).asObject()
+
+
+@pytest.mark.parametrize('format', ['yaml', 'json'])
+@pytest.mark.parametrize('template_class', TEMPLATES)
+def test_dump_sharded_matches_single_process(template_class, format):
+    template = configured(template_class)
+    expected = template.asYAML() if format == 'yaml' else template.asJSON()
+    resources = template.asObject()['resources']
+    # Shards of 2 resources, so even the small templates are split over several workers
+    assert serialization.dump_sharded(resources, format, processes=2, shard_size=2) == expected
+    assert serialization.dump_sharded(resources, format, processes=1) == expected
@@ -0,0 +1,46 @@
+import pytest
+
+from stratosphere.templates import discover_templates, render_templates
+
+TEMPLATE = '''
+from stratosphere.resources import Template
+from stratosphere.compute import Network
+{imports}
+
+
+class Net(Template):
+    TEMPLATE_TYPE = 'net-{directory}'
+
+    def configure(self):
+        self.add_resource(Network(name=constants.NAME, autoCreateSubnetworks=False))
+'''
+
+
+def write_templates(root, imports):
+    for directory in ('a', 'b'):
+        path = root / directory
+        path.mkdir()
+        (path / 'constants.py').write_text("NAME = '{}-net'\n".format(directory))
+        (path / 'net.py').write_text(TEMPLATE.format(imports=imports, directory=directory))
+
+
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_same_names_in_different_directories(tmp_path, max_workers):
+    write_templates(tmp_path, 'import constants')
+    templates = discover_templates([str(tmp_path / '*' / '*.py')])
+    assert [t.TEMPLATE_TYPE for _, t in templates] == ['net-a', 'net-b']
+
+    paths = render_templates(templates, 'project', 'dev', str(tmp_path / 'out'), max_workers=max_workers)
+    for directory, path in zip(('a', 'b'), paths):
+        with open(path) as f:
+            assert '- name: {}-net\n'.format(directory) in f.read()
+
+
+def test_shared_helper_importing_a_neighbour_fails(tmp_path, monkeypatch):
+    shared = tmp_path / 'shared'
+    shared.mkdir()
+    (shared / 'helper.py').write_text('import constants\n')
+    monkeypatch.syspath_prepend(str(shared))
+    write_templates(tmp_path, 'from helper import constants')
+    with pytest.raises(ImportError, match='uses constants from'):
+        discover_templates([str(tmp_path / 'a' / 'net.py'), str(tmp_path / 'b' / 'net.py')])
@@ -0,0 +1,82 @@
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from stratosphere.operations import Backoff
+from stratosphere.transport import Transport
+
+
+def error(status, reason):
+    content = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+    return HttpError(httplib2.Response({'status': str(status)}), content.encode('utf-8'))
+
+
+class FakeRequest(object):
+    method = 'GET'
+    uri = 'https://example.com/resource'
+
+    def __init__(self, *failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    def execute(self, http=None):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return {'ok': True}
+
+
+def transport():
+    return Transport(max_retries=3, backoff=lambda: Backoff(initial=0, jitter=0), sleep=lambda _: None)
+
+
+@pytest.mark.parametrize('failure', [error(429, 'rateLimitExceeded'), error(503, 'backendError'),
+                                     error(403, 'rateLimitExceeded'), error(403, 'userRateLimitExceeded')])
+def test_retries(failure):
+    request = FakeRequest(failure, failure)
+    assert transport().execute(request, http=object()) == {'ok': True}
+    assert request.calls == 3
+
+
+@pytest.mark.parametrize('failure', [error(403, 'forbidden'), error(404, 'notFound'), error(400, 'badRequest')])
+def test_does_not_retry(failure):
+    request = FakeRequest(failure)
+    with pytest.raises(HttpError):
+        transport().execute(request, http=object())
+    assert request.calls == 1
+
+
+def test_gives_up_after_max_retries():
+    request = FakeRequest(*[error(403, 'rateLimitExceeded')] * 5)
+    with pytest.raises(HttpError):
+        transport().execute(request, http=object())
+    assert request.calls == 4
+
+
+class FakeConnection(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def request(self, uri, method='GET'):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, content = response
+        return httplib2.Response({'status': str(status)}), content
+
+
+def test_request_retries_plain_http():
+    t = transport()
+    connection = FakeConnection(httplib2.ServerNotFoundError('offline'), (503, b''), (200, b'{}'))
+    t.connection = lambda timeout=None: connection
+    assert t.request('https://example.com/doc') == b'{}'
+
+
+def test_request_raises_ioerror():
+    t = transport()
+    connection = FakeConnection((404, b''))
+    t.connection = lambda timeout=None: connection
+    with pytest.raises(IOError):
+        t.request('https://example.com/doc')